@@ -0,0 +1,181 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Measures the startup time of the `houdini-manage` command-line interface and
+fails with exit code 1 if it exceeds the configured budget.
+
+Two measurements are taken:
+
+1. The import time of the `houdini_manage` package as reported by
+   `python -X importtime` when running `houdini-manage --version`.
+   Additionally, the modules imported for `--version` are checked against a
+   list of modules that are only needed for specific operations.
+2. The wall-clock time of every subcommand, run against a temporary Houdini
+   environment file and an empty home directory.
+
+    $ python benchmarks/startup.py --import-budget 50 --command-budget 250
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported when running `houdini-manage --version`.
+FORBIDDEN_MODULES = ['six', 'configparser', 'json', 'subprocess', 'datetime',
+                     'PyQt5', 'houdini_manage.library', 'houdini_manage.config',
+                     'houdini_manage.envfile']
+
+ENVFILE = '''\
+# BEGIN_SECTION(DEFAULT)
+HOUDINI_PATH="&"
+PYTHONPATH="&"
+# END_SECTION
+# BEGIN_SECTION(library:benchlib)
+HOUDINI_PATH="$HOUDINI_PATH;{path}"
+HLIBPATH_benchlib="{path}"
+HLIBVERSION_benchlib="1.0.0"
+# END_SECTION
+'''
+
+
+def _env(home):
+  env = os.environ.copy()
+  env['HOME'] = home
+  env['USERPROFILE'] = home
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [project_dir, env.get('PYTHONPATH')]))
+  return env
+
+
+def measure_imports(home):
+  """
+  Returns a tuple of the cumulative import time of the `houdini_manage`
+  package in milliseconds and the set of all modules that were imported.
+  """
+
+  code = 'from houdini_manage.main import _main; _main(["--version"])'
+  command = [sys.executable, '-X', 'importtime', '-c', code]
+  proc = subprocess.run(command, env=_env(home), stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE, universal_newlines=True)
+  total = 0
+  modules = set()
+  for line in proc.stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    parts = line[len('import time:'):].split('|')
+    if len(parts) != 3 or not parts[0].strip().isdigit():
+      continue  # header line
+    name = parts[2].strip()
+    modules.add(name)
+    if parts[2].startswith(' houdini_manage') and not parts[2].startswith('  '):
+      # Top-level entry, the cumulative time includes all of its children.
+      total += int(parts[1])
+  return total / 1000.0, modules
+
+
+def measure_commands(home, library_dir, envfile, repeat):
+  """
+  Returns a dictionary that maps every subcommand to its best wall-clock time
+  in milliseconds out of *repeat* runs.
+  """
+
+  commands = {
+    '--version': ['--version'],
+    '--list': [envfile, '--list'],
+    '--version-of': [envfile, '--version-of', 'benchlib'],
+    '--path-of': [envfile, '--path-of', 'benchlib'],
+    '--remove': [envfile, '--remove', 'benchlib', '--dry'],
+    '--install': [envfile, '--install', library_dir, '--overwrite', '--dry'],
+  }
+  results = {}
+  for name, args in commands.items():
+    best = None
+    for i in range(repeat):
+      tstart = time.perf_counter()
+      subprocess.check_call([sys.executable, '-m', 'houdini_manage.main'] + args,
+                            env=_env(home), stdout=subprocess.DEVNULL)
+      elapsed = (time.perf_counter() - tstart) * 1000.0
+      best = elapsed if best is None else min(best, elapsed)
+    results[name] = best
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='startup.py')
+  parser.add_argument('--import-budget', type=float, default=50.0, metavar='MS',
+    help='Maximum cumulative import time of the houdini_manage package.')
+  parser.add_argument('--command-budget', type=float, default=250.0, metavar='MS',
+    help='Maximum wall-clock time of a single subcommand.')
+  parser.add_argument('--repeat', type=int, default=5,
+    help='Number of runs per subcommand, the best run is reported.')
+  parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+  args = parser.parse_args(argv)
+
+  tempdir = tempfile.mkdtemp(prefix='houdini-manage-startup-')
+  try:
+    home = os.path.join(tempdir, 'home')
+    library_dir = os.path.join(tempdir, 'benchlib')
+    os.makedirs(home)
+    os.makedirs(library_dir)
+    with open(os.path.join(library_dir, 'houdini-library.json'), 'w') as fp:
+      json.dump({'libraryName': 'benchlib', 'libraryVersion': '1.0.0'}, fp)
+    envfile = os.path.join(tempdir, 'houdini.env')
+    with open(envfile, 'w') as fp:
+      fp.write(ENVFILE.format(path=library_dir))
+
+    import_time, modules = measure_imports(home)
+    command_times = measure_commands(home, library_dir, envfile, args.repeat)
+  finally:
+    shutil.rmtree(tempdir)
+
+  failures = []
+  if import_time > args.import_budget:
+    failures.append('import time {:.1f}ms exceeds budget of {:.1f}ms'.format(
+      import_time, args.import_budget))
+  for name in FORBIDDEN_MODULES:
+    if name in modules:
+      failures.append('"{}" is imported by houdini-manage --version'.format(name))
+  for name, elapsed in command_times.items():
+    if elapsed > args.command_budget:
+      failures.append('{} took {:.1f}ms, exceeds budget of {:.1f}ms'.format(
+        name, elapsed, args.command_budget))
+
+  if args.json:
+    json.dump({'import_time': import_time, 'commands': command_times,
+               'failures': failures}, sys.stdout, indent=2)
+    print()
+  else:
+    print('import time: {:>8.1f}ms'.format(import_time))
+    for name, elapsed in command_times.items():
+      print('{:<12} {:>8.1f}ms'.format(name + ':', elapsed))
+    for message in failures:
+      print('error:', message, file=sys.stderr)
+
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
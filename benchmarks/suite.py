@@ -0,0 +1,274 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Benchmark suite for the envfile, install and DSO build code paths. All
+workloads are synthetic: environment files with 10 to 10,000 named sections,
+library trees with a `houdini-library.json` and stub DSO sources, and a fake
+`hcustom` script, so the suite runs without Houdini.
+
+Results are written as JSON and can be compared against a previous run,
+regressions above the threshold cause exit code 1.
+
+    $ python benchmarks/suite.py -o baseline.json
+    $ python benchmarks/suite.py -o current.json --compare baseline.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_dir)
+
+from houdini_manage import __version__, library  # noqa: E402
+from houdini_manage.envfile import SectionEnvfile  # noqa: E402
+
+SECTION_COUNTS = [10, 100, 1000, 10000]
+DSO_SOURCE_COUNT = 16
+
+FAKE_HCUSTOM = '''\
+#!{python}
+# Fake hcustom used by the houdini-manage benchmark suite. Creates an empty
+# DSO named after the source file in the current directory.
+import os, sys, time
+time.sleep({delay})
+source = sys.argv[-1]
+open(os.path.splitext(os.path.basename(source))[0] + '.so', 'w').close()
+'''
+
+
+def generate_envfile(num_sections):
+  """
+  Generates the contents of a Houdini environment file with *num_sections*
+  named sections, every fourth of which is a library section. Plain content
+  is placed between the sections.
+  """
+
+  lines = ['# Generated by the houdini-manage benchmark suite\n',
+           'HOUDINI_MAX_BACKUP_FILES=10\n']
+  for i in range(num_sections):
+    if i % 4 == 0:
+      name = 'lib{}'.format(i)
+      path = '/studio/libraries/{}/1.{}.0'.format(name, i)
+      lines.append('# BEGIN_SECTION(library:{})\n'.format(name))
+      lines.append('HOUDINI_PATH="$HOUDINI_PATH:{}"\n'.format(path))
+      lines.append('PYTHONPATH="$PYTHONPATH:{}/python"\n'.format(path))
+      lines.append('HLIBPATH_{}="{}"\n'.format(name, path))
+      lines.append('HLIBVERSION_{}="1.{}.0"\n'.format(name, i))
+    else:
+      lines.append('# BEGIN_SECTION(section{})\n'.format(i))
+      lines.append('VARIABLE_{0}="value {0}"\n'.format(i))
+    lines.append('# END_SECTION\n')
+    if i % 3 == 0:
+      lines.append('# Plain content after section {}\n'.format(i))
+      lines.append('PLAIN_{0}={0}\n'.format(i))
+  return ''.join(lines)
+
+
+def generate_library(directory, name, num_sources=0, unity=None):
+  os.makedirs(os.path.join(directory, 'otls'))
+  os.makedirs(os.path.join(directory, 'python'))
+  config = {
+    'libraryName': name,
+    'libraryVersion': '1.0.0',
+    'environment': ['{}_ROOT=$HLIBPATH_{}'.format(name.upper(), name)],
+  }
+  if unity:
+    config['dsoUnity'] = unity
+  with open(os.path.join(directory, 'houdini-library.json'), 'w') as fp:
+    json.dump(config, fp)
+  if num_sources:
+    os.makedirs(os.path.join(directory, 'dso_source'))
+    for i in range(num_sources):
+      with open(os.path.join(directory, 'dso_source', 'SOP_Stub{}.cpp'.format(i)), 'w') as fp:
+        fp.write('static int stub{0}() {{ return {0}; }}\n'.format(i))
+  return directory
+
+
+def generate_hcustom(hou_app_dir, delay):
+  os.makedirs(os.path.join(hou_app_dir, 'bin'))
+  filename = os.path.join(hou_app_dir, 'bin', 'hcustom')
+  with open(filename, 'w') as fp:
+    fp.write(FAKE_HCUSTOM.format(python=sys.executable, delay=delay))
+  os.chmod(filename, 0o755)
+
+
+class Benchmark(object):
+  """
+  Runs *func* with the value returned by *setup* (if specified). Only the
+  call to *func* is timed.
+  """
+
+  def __init__(self, name, func, setup=None, repeat=None):
+    self.name = name
+    self.func = func
+    self.setup = setup
+    self.repeat = repeat
+
+  def run(self, repeat):
+    times = []
+    for i in range(self.repeat or repeat):
+      arg = self.setup() if self.setup else None
+      tstart = time.perf_counter()
+      self.func(arg)
+      times.append(time.perf_counter() - tstart)
+    return {'min': min(times), 'median': statistics.median(times), 'runs': len(times)}
+
+
+def collect_benchmarks(workdir, hcustom_delay):
+  benchmarks = []
+
+  for count in SECTION_COUNTS:
+    content = generate_envfile(count)
+    parse = lambda content: SectionEnvfile.parse(io.StringIO(content))
+    benchmarks.append(Benchmark('envfile.parse[{}]'.format(count),
+      parse, lambda content=content: content))
+    benchmarks.append(Benchmark('envfile.render[{}]'.format(count),
+      lambda env: env.render(io.StringIO()), lambda content=content: parse(content)))
+    if count == SECTION_COUNTS[-1]:
+      envfile = os.path.join(workdir, 'houdini.env')
+      with open(envfile, 'w') as fp:
+        fp.write(content)
+
+  library_dir = generate_library(os.path.join(workdir, 'benchlib'), 'benchlib')
+  for count in SECTION_COUNTS:
+    content = generate_envfile(count)
+    benchmarks.append(Benchmark('library.install_library[{}]'.format(count),
+      lambda env: library.install_library(env, library_dir),
+      lambda content=content: SectionEnvfile.parse(io.StringIO(content))))
+    benchmarks.append(Benchmark('library.remove_library[{}]'.format(count),
+      lambda env: library.remove_library(env, 'lib0'),
+      lambda content=content: SectionEnvfile.parse(io.StringIO(content))))
+
+  cli_env = os.environ.copy()
+  cli_env['HOME'] = os.path.join(workdir, 'home')
+  cli_env['USERPROFILE'] = cli_env['HOME']
+  cli_env['PYTHONPATH'] = os.pathsep.join(filter(None, [project_dir, cli_env.get('PYTHONPATH')]))
+  last = 'lib{}'.format((SECTION_COUNTS[-1] - 1) // 4 * 4)
+  for args in [['--list'], ['--version-of', last], ['--path-of', last]]:
+    command = [sys.executable, '-m', 'houdini_manage.main', envfile] + args
+    benchmarks.append(Benchmark('cli{}[{}]'.format(args[0], SECTION_COUNTS[-1]),
+      lambda _, command=command: subprocess.check_call(command, env=cli_env,
+        stdout=subprocess.DEVNULL)))
+
+  if os.name != 'nt':
+    # The fake hcustom relies on the shebang line, which Windows does not
+    # support (build_dso() expects bin\hcustom.exe there).
+    hou_app_dir = os.path.join(workdir, 'hfs')
+    generate_hcustom(hou_app_dir, hcustom_delay)
+    for unity in [None, 1, 4]:
+      name = 'dsolib{}'.format(unity or 0)
+      directory = generate_library(os.path.join(workdir, name), name,
+                                   DSO_SOURCE_COUNT, unity)
+      benchmarks.append(Benchmark('library.build_dso[{},unity={}]'.format(DSO_SOURCE_COUNT, unity or 0),
+        lambda _, directory=directory: _quiet(library.build_dso, hou_app_dir, directory),
+        repeat=3))
+
+  return benchmarks
+
+
+def _quiet(func, *args):
+  stdout = sys.stdout
+  sys.stdout = io.StringIO()
+  try:
+    return func(*args)
+  finally:
+    sys.stdout = stdout
+
+
+def compare(old, new, threshold):
+  """
+  Compares the minimum times of two result sets. Returns a list of
+  `(name, old_time, new_time, ratio, regressed)` tuples.
+  """
+
+  rows = []
+  for name, result in new['results'].items():
+    if name not in old['results']:
+      continue
+    old_time = old['results'][name]['min']
+    new_time = result['min']
+    ratio = new_time / old_time if old_time else float('inf')
+    rows.append((name, old_time, new_time, ratio, ratio > 1.0 + threshold))
+  return rows
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='suite.py')
+  parser.add_argument('-o', '--output', metavar='FILE', help='Write the results to FILE.')
+  parser.add_argument('-c', '--compare', metavar='FILE', help='Compare with the results in FILE.')
+  parser.add_argument('-t', '--threshold', type=float, default=0.1,
+    help='Relative slowdown that is reported as a regression (default: 0.1).')
+  parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of runs per benchmark.')
+  parser.add_argument('-k', '--filter', metavar='TEXT', help='Only run benchmarks that contain TEXT.')
+  parser.add_argument('--hcustom-delay', type=float, default=0.02, metavar='SECONDS',
+    help='Time the fake hcustom spends per invocation (default: 0.02).')
+  args = parser.parse_args(argv)
+
+  workdir = tempfile.mkdtemp(prefix='houdini-manage-bench-')
+  try:
+    os.makedirs(os.path.join(workdir, 'home'))
+    results = {}
+    for benchmark in collect_benchmarks(workdir, args.hcustom_delay):
+      if args.filter and args.filter not in benchmark.name:
+        continue
+      result = results[benchmark.name] = benchmark.run(args.repeat)
+      print('{:<40} {:>10.2f}ms {:>10.2f}ms'.format(
+        benchmark.name, result['min'] * 1000, result['median'] * 1000))
+  finally:
+    shutil.rmtree(workdir)
+
+  data = {
+    'meta': {
+      'version': __version__,
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    },
+    'results': results,
+  }
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(data, fp, indent=2, sort_keys=True)
+
+  status = 0
+  if args.compare:
+    with open(args.compare) as fp:
+      old = json.load(fp)
+    print()
+    for name, old_time, new_time, ratio, regressed in compare(old, data, args.threshold):
+      print('{:<40} {:>10.2f}ms -> {:>10.2f}ms {:>+7.1f}%{}'.format(
+        name, old_time * 1000, new_time * 1000, (ratio - 1.0) * 100,
+        '  REGRESSION' if regressed else ''))
+      if regressed:
+        status = 1
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main())
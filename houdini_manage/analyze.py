@@ -0,0 +1,334 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Estimates the file system work that Houdini does at startup for a given
+environment file. The variables of the envfile are evaluated and the search
+paths for every resource type are resolved and listed like Houdini would,
+counting the directories and entries that are examined. This is an
+approximation, Houdini may look at fewer entries (eg. only specific files in
+`scripts/`) or more (eg. recursing into `.hda` directories).
+"""
+
+import os
+import re
+from . import tracing
+from .envfile import unquote
+
+# Maps the resource types to the environment variable that overrides the
+# search path and the subdirectory of every `HOUDINI_PATH` entry that is
+# used by default.
+RESOURCE_TYPES = [
+  ('otls', 'HOUDINI_OTLSCAN_PATH', 'otls'),
+  ('dso', 'HOUDINI_DSO_PATH', 'dso'),
+  ('toolbar', 'HOUDINI_TOOLBAR_PATH', 'toolbar'),
+  ('python', None, None),
+  ('scripts', 'HOUDINI_SCRIPT_PATH', 'scripts'),
+]
+
+OTHER = '(other)'
+
+
+def evaluate_envfile(env, environ=None, default_paths=None):
+  """
+  Evaluates the variable assignments in the `SectionEnvfile` *env* in order
+  and returns a dictionary of the resulting values. References to variables
+  that are not assigned in the envfile are looked up in *environ* (defaults
+  to `os.environ`). The special `&` entry in `HOUDINI_PATH` is replaced by
+  *default_paths*, other `&` entries are kept.
+  """
+
+  if environ is None:
+    environ = os.environ
+  variables = {}
+
+  def lookup(match):
+    name = match.group(1) or match.group(2)
+    return variables.get(name, environ.get(name, ''))
+
+  for section in env.sections:
+    for line in section.content.split('\n'):
+      line = line.strip()
+      match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)$', line)
+      if not match:
+        continue
+      name, value = match.groups()
+      value = unquote(value)
+      value = re.sub(r'\$\{([A-Za-z0-9_]+)\}|\$([A-Za-z_][A-Za-z0-9_]*)', lookup, value)
+      if name == 'HOUDINI_PATH' and default_paths is not None:
+        value = join_path([x for item in split_path(value)
+                           for x in (default_paths if item == '&' else [item])])
+      variables[name] = value
+
+  return variables
+
+
+def split_path(value):
+  """
+  Splits a Houdini search path. Houdini accepts `;` on all platforms and
+  `:` on platforms other than Windows.
+  """
+
+  if os.name == 'nt':
+    return [x for x in value.split(';') if x]
+  items = []
+  for part in value.split(';'):
+    for item in part.split(':'):
+      # Re-join drive letters of Windows paths, eg. "C" and "/foo".
+      if items and len(items[-1]) == 1 and items[-1].isalpha() and item[:1] in '/\\':
+        items[-1] += ':' + item
+      else:
+        items.append(item)
+  return [x for x in items if x]
+
+
+def join_path(items):
+  return ';'.join(items)
+
+
+def get_default_paths(envfile, hou_app_dir=None):
+  """
+  Returns the paths that Houdini uses for `&` in `HOUDINI_PATH`: the user
+  preferences directory (the directory of *envfile*) and `$HFS/houdini`.
+  """
+
+  paths = [os.path.dirname(os.path.abspath(envfile))]
+  if hou_app_dir:
+    paths.append(os.path.join(hou_app_dir, 'houdini'))
+  return paths
+
+
+def get_search_paths(variables, python_libs):
+  """
+  Returns a dictionary that maps every resource type to the list of
+  directories that Houdini searches for it.
+  """
+
+  houdini_path = split_path(variables.get('HOUDINI_PATH', ''))
+  result = {}
+  for type_name, var, subdir in RESOURCE_TYPES:
+    if type_name == 'python':
+      paths = [x for x in split_path(variables.get('PYTHONPATH', '')) if x != '&']
+      paths += [os.path.join(x, python_libs) for x in houdini_path]
+    else:
+      paths = []
+      for item in split_path(variables.get(var, '&')):
+        if item == '&':
+          item = '@/' + subdir
+        if item.startswith('@'):
+          paths += [x + item[1:] for x in houdini_path]
+        else:
+          paths.append(item)
+    result[type_name] = [os.path.normpath(x) for x in paths]
+  return result
+
+
+class ListingCache(object):
+  """
+  Caches directory listings, validated by the modification time of the
+  directory. If a *filename* is specified, the cache is loaded from and can
+  be saved to that file.
+  """
+
+  def __init__(self, filename=None):
+    self.filename = filename
+    self.entries = {}
+    self.changed = False
+    if filename:
+      import json
+      try:
+        with open(filename) as fp:
+          self.entries = json.load(fp)
+      except (OSError, ValueError):
+        pass
+
+  def listdir(self, path):
+    """
+    Returns the list of entries in *path* or `None` if it is not a directory.
+    """
+
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      return None
+    entry = self.entries.get(path)
+    if entry and entry[0] == mtime:
+      return entry[1]
+    try:
+      names = os.listdir(path)
+    except OSError:
+      return None
+    self.entries[path] = [mtime, names]
+    self.changed = True
+    return names
+
+  def save(self):
+    if not self.filename or not self.changed:
+      return
+    import json
+    from .config import write_atomic
+    write_atomic(self.filename, json.dumps(self.entries))
+    self.changed = False
+
+
+class TypeStats(object):
+
+  def __init__(self):
+    self.dirs = 0
+    self.missing = 0
+    self.entries = 0
+
+  def add(self, listing):
+    self.dirs += 1
+    if listing is None:
+      self.missing += 1
+    else:
+      self.entries += len(listing)
+
+  @property
+  def cost(self):
+    # Every directory costs at least one stat, every entry one more.
+    return self.dirs + self.entries
+
+  def to_json(self):
+    return {'dirs': self.dirs, 'missing': self.missing, 'entries': self.entries}
+
+
+class Analysis(object):
+  """
+  The result of `analyze_envfile()`. *types* maps every resource type to a
+  `TypeStats` object and *libraries* maps the library names to a dictionary
+  of their `TypeStats` per resource type. Directories that do not belong to
+  a library are accounted to `OTHER`.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.types = dict((x[0], TypeStats()) for x in RESOURCE_TYPES)
+    self.libraries = {}
+
+  @property
+  def total(self):
+    result = TypeStats()
+    for stats in self.types.values():
+      result.dirs += stats.dirs
+      result.missing += stats.missing
+      result.entries += stats.entries
+    return result
+
+  def get_library_cost(self, name):
+    return sum(x.cost for x in self.libraries.get(name, {}).values())
+
+  def ranked_libraries(self):
+    return sorted(self.libraries, key=lambda x: -self.get_library_cost(x))
+
+  def to_json(self):
+    return {
+      'filename': self.filename,
+      'total': self.total.to_json(),
+      'types': dict((k, v.to_json()) for k, v in self.types.items()),
+      'libraries': dict((name, dict((k, v.to_json()) for k, v in types.items()))
+                        for name, types in self.libraries.items()),
+    }
+
+
+def analyze_envfile(filename, env, cache=None, hou_app_dir=None, python_libs=None):
+  """
+  Analyzes the `SectionEnvfile` *env* that was loaded from *filename*. A
+  `ListingCache` can be passed to share directory listings between
+  multiple analyses.
+  """
+
+  from .config import config
+  if cache is None:
+    cache = ListingCache()
+  if python_libs is None:
+    python_libs = config['pythonlibs']
+
+  with tracing.span('analyze.envfile', filename=filename):
+    variables = evaluate_envfile(env, default_paths=get_default_paths(filename, hou_app_dir))
+
+    library_paths = []
+    for section in env.iter_named_sections():
+      name = section.get_library_name()
+      path = name and variables.get('HLIBPATH_' + name)
+      if path:
+        library_paths.append((os.path.normcase(os.path.normpath(path)), name))
+
+    def owner(path):
+      path = os.path.normcase(path)
+      for lib_path, name in library_paths:
+        if path == lib_path or path.startswith(lib_path + os.sep):
+          return name
+      return OTHER
+
+    result = Analysis(filename)
+    for type_name, paths in get_search_paths(variables, python_libs).items():
+      for path in paths:
+        listing = cache.listdir(path)
+        result.types[type_name].add(listing)
+        library = result.libraries.setdefault(owner(path), {})
+        library.setdefault(type_name, TypeStats()).add(listing)
+
+  return result
+
+
+def format_analysis(analysis, compare=None):
+  """
+  Formats the *analysis* as a table. If a second analysis is passed with
+  *compare*, the difference is shown as well.
+  """
+
+  lines = []
+  total = analysis.total
+  lines.append('{}: {} entries in {} directories ({} missing)'.format(
+    analysis.filename, total.entries, total.dirs, total.missing))
+  if compare:
+    other = compare.total
+    lines.append('{}: {} entries in {} directories ({} missing)'.format(
+      compare.filename, other.entries, other.dirs, other.missing))
+  lines.append('')
+
+  header = '  {:<10} {:>6} {:>8} {:>8}'.format('type', 'dirs', 'missing', 'entries')
+  if compare:
+    header += ' {:>8}'.format('delta')
+  lines.append(header)
+  for type_name, _, _ in RESOURCE_TYPES:
+    stats = analysis.types[type_name]
+    line = '  {:<10} {:>6} {:>8} {:>8}'.format(type_name, stats.dirs, stats.missing, stats.entries)
+    if compare:
+      line += ' {:>+8}'.format(compare.types[type_name].cost - stats.cost)
+    lines.append(line)
+  lines.append('')
+
+  names = analysis.ranked_libraries()
+  if compare:
+    names += [x for x in compare.ranked_libraries() if x not in names]
+  width = max([len(x) for x in names] + [7])
+  header = '  {:<{w}} {:>8}'.format('library', 'cost', w=width)
+  if compare:
+    header += ' {:>8}'.format('delta')
+  lines.append(header)
+  for name in names:
+    cost = analysis.get_library_cost(name)
+    line = '  {:<{w}} {:>8}'.format(name, cost, w=width)
+    if compare:
+      line += ' {:>+8}'.format(compare.get_library_cost(name) - cost)
+    lines.append(line)
+  return '\n'.join(lines)
@@ -0,0 +1,319 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Installs libraries from zip and tar archives into a content-addressed store.
+
+Every file is stored once under `objects/` by its SHA-256 hash and then
+hard-linked into `libraries/<libraryName>/<libraryVersion>/`, thus files that
+did not change between two versions of a library only occupy disk space once.
+Objects are read-only since modifying one in place would affect all library
+versions that link to it.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from .config import config, get_data_dir
+from .library import CONFIG_FILE, InstallError, NotALibraryError
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+                    '.tar.xz', '.txz')
+
+# Members of at least this size are extracted in a worker thread.
+LARGE_MEMBER_SIZE = 1024 * 1024
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def is_archive(path):
+  return os.path.isfile(path) and path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def get_store_directory():
+  return config.get('librarystore') or os.path.join(get_data_dir(), 'store')
+
+
+class ArchiveError(InstallError):
+  pass
+
+
+class _Member(object):
+
+  def __init__(self, name, size, executable, info):
+    self.name = name
+    self.size = size
+    self.executable = executable
+    self.info = info
+
+
+class _ZipReader(object):
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.zf = zipfile.ZipFile(filename)
+    self._local = threading.local()
+    self._handles = []
+    self._lock = threading.Lock()
+
+  def close(self):
+    self.zf.close()
+    for zf in self._handles:
+      zf.close()
+
+  def members(self):
+    for info in self.zf.infolist():
+      if info.is_dir():
+        continue
+      executable = bool((info.external_attr >> 16) & 0o111)
+      yield _Member(info.filename, info.file_size, executable, info)
+
+  def open(self, member):
+    return self.zf.open(member.info)
+
+  def open_parallel(self, member):
+    # ZipFile objects must not be shared between threads, every worker
+    # thread opens the archive once and reuses it for all its members.
+    zf = getattr(self._local, 'zf', None)
+    if zf is None:
+      zf = self._local.zf = zipfile.ZipFile(self.filename)
+      with self._lock:
+        self._handles.append(zf)
+    return zf.open(member.info)
+
+  supports_parallel = True
+
+
+class _TarReader(object):
+  """
+  Tar archives are usually compressed as a whole and can only be read
+  sequentially, members are therefore never extracted in parallel.
+  """
+
+  supports_parallel = False
+
+  def __init__(self, filename):
+    self.tf = tarfile.open(filename, 'r:*')
+
+  def close(self):
+    self.tf.close()
+
+  def members(self):
+    for info in self.tf:
+      if not info.isfile():
+        continue
+      yield _Member(info.name, info.size, bool(info.mode & 0o111), info)
+
+  def open(self, member):
+    return self.tf.extractfile(member.info)
+
+
+def _open_archive(filename):
+  if filename.lower().endswith('.zip'):
+    return _ZipReader(filename)
+  return _TarReader(filename)
+
+
+def _normalize_name(name):
+  """
+  Normalizes a member name to use forward slashes and rejects names that
+  would be extracted outside of the target directory.
+  """
+
+  name = name.replace('\\', '/')
+  parts = [x for x in name.split('/') if x and x != '.']
+  if not parts or name.startswith('/') or '..' in parts or ':' in parts[0]:
+    raise ArchiveError('invalid member name in archive: {!r}'.format(name))
+  return '/'.join(parts)
+
+
+def read_library_config(filename):
+  """
+  Reads the `houdini-library.json` from the archive *filename* without
+  extracting any other member. The file must be at the root of the archive,
+  or in a top-level directory that contains all members of the archive.
+  Returns a tuple of the library configuration and the member name prefix of
+  the library (either an empty string or the top-level directory name with a
+  trailing slash).
+  """
+
+  reader = _open_archive(filename)
+  try:
+    config_member = None
+    top_level = set()
+    for member in reader.members():
+      parts = _normalize_name(member.name).split('/')
+      if parts == [CONFIG_FILE]:
+        # A configuration file at the root always takes precedence.
+        config_member, top_level = member, None
+        break
+      top_level.add(parts[0] if len(parts) > 1 else '')
+      if len(parts) == 2 and parts[1] == CONFIG_FILE:
+        config_member = member
+    if config_member is None:
+      raise NotALibraryError('missing library configuration file in archive: {}'.format(filename))
+    prefix = ''
+    if top_level is not None:
+      prefix = _normalize_name(config_member.name).split('/')[0] + '/'
+      if len(top_level) != 1:
+        raise ArchiveError('{} must be at the root of the archive or in a single top-level '
+                           'directory: {}'.format(CONFIG_FILE, filename))
+    with reader.open(config_member) as fp:
+      try:
+        library_config = json.load(io.TextIOWrapper(fp, encoding='utf8'))
+      except ValueError as exc:
+        raise ArchiveError('invalid {} in {}: {}'.format(CONFIG_FILE, filename, exc))
+    return library_config, prefix
+  finally:
+    reader.close()
+
+
+class ObjectStore(object):
+  """
+  Content-addressed file store. Objects are keyed by the SHA-256 of their
+  contents and whether they are executable.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.objects_dir = os.path.join(directory, 'objects')
+    self.temp_dir = os.path.join(directory, 'tmp')
+    self.libraries_dir = os.path.join(directory, 'libraries')
+
+  def add_stream(self, fp, executable=False):
+    """
+    Copies the contents of the file-like object *fp* into the store and
+    returns the path to the object.
+    """
+
+    os.makedirs(self.temp_dir, exist_ok=True)
+    hasher = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=self.temp_dir, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as dst:
+        while True:
+          chunk = fp.read(_CHUNK_SIZE)
+          if not chunk:
+            break
+          hasher.update(chunk)
+          dst.write(chunk)
+      digest = hasher.hexdigest() + ('.x' if executable else '')
+      path = os.path.join(self.objects_dir, digest[:2], digest)
+      if os.path.isfile(path):
+        return path
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      mode = 0o555 if executable else 0o444
+      os.chmod(tmp, mode)
+      try:
+        os.replace(tmp, path)
+      except OSError:
+        # Another thread or process may have added the same object.
+        if not os.path.isfile(path):
+          raise
+      return path
+    finally:
+      if os.path.exists(tmp):
+        _remove(tmp)
+
+  def link(self, path, dest):
+    """
+    Hard-links the object *path* to *dest*. Falls back to copying if the
+    filesystem does not support hard links.
+    """
+
+    try:
+      os.link(path, dest)
+    except OSError:
+      shutil.copy2(path, dest)
+
+  def get_library_directory(self, name, version):
+    return os.path.join(self.libraries_dir, name, version)
+
+
+def extract_library(filename, store=None, jobs=None):
+  """
+  Extracts the library archive *filename* into the `ObjectStore` *store*
+  (defaults to the store configured with the `libraryStore` option) and
+  returns the directory of the extracted library.
+  """
+
+  if store is None:
+    store = ObjectStore(get_store_directory())
+  library_config, prefix = read_library_config(filename)
+  try:
+    name, version = library_config['libraryName'], library_config['libraryVersion']
+  except KeyError as exc:
+    raise ArchiveError('missing {} in {} of {}'.format(exc, CONFIG_FILE, filename))
+  target = store.get_library_directory(name, str(version))
+  staging = '{}.{}.tmp'.format(target, os.getpid())
+  if os.path.exists(staging):
+    _rmtree(staging)
+  os.makedirs(staging)
+
+  def process(member, open_member):
+    dest = os.path.join(staging, *_normalize_name(member.name)[len(prefix):].split('/'))
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    with open_member(member) as fp:
+      obj = store.add_stream(fp, member.executable)
+    store.link(obj, dest)
+
+  reader = _open_archive(filename)
+  try:
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+      futures = []
+      for member in reader.members():
+        if not _normalize_name(member.name).startswith(prefix):
+          continue
+        if reader.supports_parallel and member.size >= LARGE_MEMBER_SIZE:
+          futures.append(pool.submit(process, member, reader.open_parallel))
+        else:
+          process(member, reader.open)
+      for future in futures:
+        future.result()
+  except BaseException:
+    _rmtree(staging)
+    raise
+  finally:
+    reader.close()
+
+  if os.path.exists(target):
+    _rmtree(target)
+  os.replace(staging, target)
+  return target
+
+
+def _remove(path):
+  os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+  os.remove(path)
+
+
+def _rmtree(path):
+  def onerror(func, path, exc_info):
+    # Objects are read-only, which prevents their removal on Windows.
+    os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+    func(path)
+  shutil.rmtree(path, onerror=onerror)
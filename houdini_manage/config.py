@@ -18,29 +18,141 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from six.moves import configparser
+"""
+Layered configuration for Houdini-Manage. Values are resolved from the
+following sources, later sources take precedence:
+
+1. Built-in defaults (`DEFAULTS`)
+2. Site configuration files listed in `HOUDINI_MANAGE_SITE_CONFIG`
+3. The user configuration file `~/.houdini-manage.ini`
+4. Environment variables `HOUDINI_MANAGE_<OPTION>`
+5. Overrides, usually from the command-line (`--config OPTION=VALUE`)
+
+Site configuration files usually live on a network share. The merged values
+of the configuration files are cached in the local cache directory and the
+site files are only checked for modifications every `SITE_CHECK_INTERVAL`
+seconds.
+"""
+
 import os
+import threading
+import time
+from . import tracing
 
-parser = configparser.SafeConfigParser()
 filename = os.path.expanduser('~/.houdini-manage.ini')
-if os.path.isfile(filename):
-  parser.read([filename])
+
+SECTION = 'houdini-manage'
+ENV_PREFIX = 'HOUDINI_MANAGE_'
+ENV_RESERVED = ('SITE_CONFIG', 'CACHE_DIR', 'DATA_DIR', 'PROFILE')
+SITE_CHECK_INTERVAL = 60
+
+# Increment when the way the configuration files are read changes to
+# invalidate cached values.
+CACHE_VERSION = 2
+
+DEFAULTS = {
+  'houdinienv': 'houdini16.0',
+  'pythonlibs': 'python2.7libs',
+  'backend': 'envfile',
+}
+
+
+def get_cache_dir():
+  """
+  Returns the directory where Houdini-Manage stores cached data. Can be
+  changed with the `HOUDINI_MANAGE_CACHE_DIR` environment variable.
+  """
+
+  directory = os.getenv('HOUDINI_MANAGE_CACHE_DIR')
+  if not directory:
+    if os.name == 'nt' and os.getenv('LOCALAPPDATA'):
+      directory = os.path.join(os.getenv('LOCALAPPDATA'), 'houdini-manage', 'cache')
+    else:
+      base = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+      directory = os.path.join(base, 'houdini-manage')
+  return directory
+
+
+def get_data_dir():
+  """
+  Returns the directory where Houdini-Manage stores persistent data, such as
+  libraries installed from archives. Can be changed with the
+  `HOUDINI_MANAGE_DATA_DIR` environment variable.
+  """
+
+  directory = os.getenv('HOUDINI_MANAGE_DATA_DIR')
+  if not directory:
+    if os.name == 'nt' and os.getenv('LOCALAPPDATA'):
+      directory = os.path.join(os.getenv('LOCALAPPDATA'), 'houdini-manage', 'data')
+    else:
+      base = os.getenv('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+      directory = os.path.join(base, 'houdini-manage')
+  return directory
+
+
+def get_site_config_files():
+  value = os.getenv('HOUDINI_MANAGE_SITE_CONFIG', '')
+  return [x for x in value.split(os.pathsep) if x]
+
+
+def _stat(filename):
+  try:
+    st = os.stat(filename)
+  except OSError:
+    return None
+  return [st.st_mtime, st.st_size]
+
+
+def write_atomic(filename, data):
+  """
+  Writes *data* to a temporary file next to *filename* and replaces
+  *filename* with it, thus readers never see a partially written file.
+  """
+
+  directory = os.path.dirname(filename)
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  tmp = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+  try:
+    with open(tmp, 'w') as fp:
+      fp.write(data)
+    os.replace(tmp, filename)
+  except BaseException:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    raise
 
 
 class ConfigWrapper(object):
+  """
+  Wraps a section of a `configparser.ConfigParser`. If no *parser* is
+  specified, the configuration is read from *filename* on first access, thus
+  neither the `configparser` module is imported nor the file is parsed unless
+  the configuration is actually needed.
+  """
 
   def __init__(self, parser, section, filename):
-    self.parser = parser
-    if not parser.has_section(section):
-      parser.add_section(section)
+    self._parser = parser
     self.section = section
     self.filename = filename
 
+  @property
+  def parser(self):
+    if self._parser is None:
+      import configparser
+      parser = configparser.ConfigParser(interpolation=None)
+      if os.path.isfile(self.filename):
+        parser.read([self.filename])
+      self._parser = parser
+    if not self._parser.has_section(self.section):
+      self._parser.add_section(self.section)
+    return self._parser
+
   def __getitem__(self, key):
-    try:
-      return self.parser.get(self.section, key)
-    except configparser.NoOptionError:
-      raise KeyError(key) from None
+    parser = self.parser
+    if not parser.has_option(self.section, key):
+      raise KeyError(key)
+    return parser.get(self.section, key)
 
   def __setitem__(self, key, value):
     self.parser.set(self.section, key, str(value))
@@ -56,4 +168,151 @@ class ConfigWrapper(object):
       self.parser.write(fp)
 
 
-config = ConfigWrapper(parser, 'houdini-manage', filename)
+class LayeredConfig(object):
+  """
+  Resolves configuration values from multiple layers (see module docs).
+  Assignments go to the user configuration file and are written with
+  `save()`.
+  """
+
+  def __init__(self, defaults, site_files, user_file, section=SECTION,
+               env_prefix=ENV_PREFIX, cache_file=None,
+               site_check_interval=SITE_CHECK_INTERVAL):
+    self.defaults = dict(defaults)
+    self.site_files = list(site_files)
+    self.user = ConfigWrapper(None, section, user_file)
+    self.section = section
+    self.env_prefix = env_prefix
+    self.cache_file = cache_file
+    self.site_check_interval = site_check_interval
+    self.overrides = {}
+    self._files = None
+
+  def _read_files(self):
+    """
+    Parses all configuration files and returns the merged values.
+    """
+
+    import configparser
+    values = {}
+    for filename in self.site_files + [self.user.filename]:
+      parser = configparser.ConfigParser(interpolation=None)
+      try:
+        parser.read([filename])
+      except configparser.Error:
+        continue
+      if parser.has_section(self.section):
+        values.update(parser.items(self.section))
+    return values
+
+  def _load_cache(self):
+    import json
+    try:
+      with open(self.cache_file) as fp:
+        cache = json.load(fp)
+    except (OSError, ValueError):
+      return None
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+      return None
+    if cache.get('site_files') != self.site_files:
+      return None
+    if cache.get('user_file') != [self.user.filename, _stat(self.user.filename)]:
+      return None
+    if time.time() - cache.get('site_checked', 0) > self.site_check_interval:
+      if cache.get('site_stats') != [_stat(x) for x in self.site_files]:
+        return None
+      cache['site_checked'] = time.time()
+      self._save_cache(cache)
+    return cache.get('values')
+
+  def _save_cache(self, cache):
+    import json
+    try:
+      write_atomic(self.cache_file, json.dumps(cache))
+    except OSError:
+      pass
+
+  def _get_files(self):
+    if self._files is None:
+      with tracing.span('config.load') as args:
+        self._files = self._load_files(args)
+    return self._files
+
+  def _load_files(self, args):
+    values = self._load_cache() if self.cache_file else None
+    args['cached'] = values is not None
+    if values is None:
+      # Stat before reading so that a concurrent modification results in
+      # a cache miss on the next run rather than in stale values.
+      user_stat = _stat(self.user.filename)
+      site_stats = [_stat(x) for x in self.site_files]
+      values = self._read_files()
+      if self.cache_file:
+        self._save_cache({
+          'version': CACHE_VERSION,
+          'site_files': self.site_files,
+          'site_stats': site_stats,
+          'site_checked': time.time(),
+          'user_file': [self.user.filename, user_stat],
+          'values': values,
+        })
+    return values
+
+  def _get_env(self):
+    result = {}
+    for key, value in os.environ.items():
+      key = key.upper()
+      if key.startswith(self.env_prefix) and key[len(self.env_prefix):] not in ENV_RESERVED:
+        result[key[len(self.env_prefix):].lower()] = value
+    return result
+
+  def layers(self):
+    """
+    Returns a list of `(name, values)` tuples in the order of precedence,
+    lowest first.
+    """
+
+    return [
+      ('defaults', self.defaults),
+      ('files', self._get_files()),
+      ('environment', self._get_env()),
+      ('overrides', self.overrides),
+    ]
+
+  def as_dict(self):
+    result = {}
+    for name, values in self.layers():
+      result.update(values)
+    return result
+
+  def set_override(self, key, value):
+    self.overrides[key.lower()] = value
+
+  def reload(self):
+    self._files = None
+
+  def __getitem__(self, key):
+    key = key.lower()
+    for name, values in reversed(self.layers()):
+      if key in values:
+        return values[key]
+    raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    self.user[key.lower()] = value
+    if self._files is not None:
+      self._files[key.lower()] = str(value)
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def save(self):
+    self.user.save()
+    self.reload()
+
+
+config = LayeredConfig(DEFAULTS, get_site_config_files(), filename,
+                       cache_file=os.path.join(get_cache_dir(), 'config.json'))
@@ -0,0 +1,254 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Finds the libraries below the directories listed in the `searchPaths`
+configuration option, so they can be installed by name.
+
+The `DiscoveryIndex` stores the modification time and the subdirectories of
+every directory that was walked, and the name and version of every library
+that was found. A refresh only lists directories whose modification time
+changed, all other directories cost a single `stat()`. Directories are
+visited in parallel and the walk does not descend into libraries, hidden
+directories or symbolic links.
+"""
+
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from . import tracing
+from .config import config, get_cache_dir, write_atomic
+from .library import CONFIG_FILE, get_mtime
+
+# Increment when the format of the index changes.
+INDEX_VERSION = 1
+
+
+def get_search_roots():
+  """
+  Returns the list of directories in the `searchPaths` configuration option.
+  """
+
+  from .analyze import split_path
+  value = config.get('searchpaths') or ''
+  return [os.path.normpath(os.path.abspath(os.path.expanduser(x))) for x in split_path(value)]
+
+
+def get_index_filename():
+  return os.path.join(get_cache_dir(), 'discovery.json')
+
+
+def parse_spec(spec):
+  """
+  Splits a `NAME[@VERSION]` string into a tuple of the name and version. The
+  version is `None` if it is not specified.
+  """
+
+  name, _, version = spec.partition('@')
+  return name, version or None
+
+
+def version_key(version):
+  """
+  Returns a key to sort library versions, numeric parts are compared as
+  numbers.
+  """
+
+  return [(1, int(x), '') if x.isdigit() else (0, 0, x)
+          for x in re.split(r'[.\-_+]', str(version))]
+
+
+class LibraryEntry(object):
+
+  def __init__(self, name, version, path):
+    self.name = name
+    self.version = version
+    self.path = path
+
+  def to_json(self):
+    return {'name': self.name, 'version': self.version, 'path': self.path}
+
+
+def _read_library(path, config_mtime):
+  """
+  Returns the `[config_mtime, name, version]` list for the library in *path*.
+  The name and version are `None` if the configuration file is invalid.
+  """
+
+  try:
+    with open(os.path.join(path, CONFIG_FILE)) as fp:
+      data = json.load(fp)
+    return [config_mtime, data['libraryName'], str(data['libraryVersion'])]
+  except (OSError, ValueError, TypeError, KeyError):
+    return [config_mtime, None, None]
+
+
+def _visit(path, cached):
+  """
+  Returns the index entry for the directory *path*, a list of its
+  modification time, its subdirectories and the library information (or
+  `None`), or `None` if *path* is not a directory. The *cached* entry is
+  reused if the directory did not change.
+  """
+
+  try:
+    mtime = os.stat(path).st_mtime
+  except OSError:
+    return None
+  if cached and cached[0] == mtime:
+    library = cached[2]
+    if library is None:
+      return cached
+    # Editing the configuration file in place does not change the
+    # modification time of the directory.
+    config_mtime = get_mtime(os.path.join(path, CONFIG_FILE))
+    if config_mtime == library[0]:
+      return cached
+    return [mtime, [], _read_library(path, config_mtime)]
+
+  subdirs = []
+  is_library = False
+  try:
+    entries = list(os.scandir(path))
+  except OSError:
+    return None
+  for entry in entries:
+    try:
+      if entry.name == CONFIG_FILE and entry.is_file():
+        is_library = True
+      elif not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+        subdirs.append(entry.name)
+    except OSError:
+      pass
+  if is_library:
+    return [mtime, [], _read_library(path, get_mtime(os.path.join(path, CONFIG_FILE)))]
+  return [mtime, sorted(subdirs), None]
+
+
+class DiscoveryIndex(object):
+  """
+  Maps library names and versions to the directories they were found in. If
+  a *filename* is specified, the index is loaded from and can be saved to
+  that file.
+  """
+
+  def __init__(self, filename=None):
+    self.filename = filename
+    self.roots = []
+    self.dirs = {}
+    self.changed = False
+    if filename:
+      try:
+        with open(filename) as fp:
+          data = json.load(fp)
+      except (OSError, ValueError):
+        data = None
+      if isinstance(data, dict) and data.get('version') == INDEX_VERSION:
+        self.roots = data['roots']
+        self.dirs = data['dirs']
+
+  def refresh(self, roots=None, jobs=None, stop=None):
+    """
+    Walks the search *roots* (defaults to `get_search_roots()`) and updates
+    the index. Directories that did not change are not listed again. If the
+    `threading.Event` *stop* is set during the walk, the refresh is cancelled
+    and the index is left unchanged. Returns False if it was cancelled.
+    """
+
+    if roots is None:
+      roots = get_search_roots()
+    dirs = {}
+    with tracing.span('discover.refresh', roots=len(roots)) as span_args:
+      with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = [(x, pool.submit(_visit, x, self.dirs.get(x))) for x in roots]
+        while pending:
+          if stop is not None and stop.is_set():
+            for _, future in pending:
+              future.cancel()
+            span_args['cancelled'] = True
+            return False
+          path, future = pending.pop()
+          entry = future.result()
+          if entry is None or path in dirs:
+            continue
+          dirs[path] = entry
+          for name in entry[1]:
+            subdir = os.path.join(path, name)
+            pending.append((subdir, pool.submit(_visit, subdir, self.dirs.get(subdir))))
+      span_args['dirs'] = len(dirs)
+    if dirs != self.dirs or roots != self.roots:
+      self.changed = True
+    self.roots = list(roots)
+    self.dirs = dirs
+    return True
+
+  def libraries(self):
+    """
+    Returns a list of `LibraryEntry` objects sorted by name and version.
+    """
+
+    result = [LibraryEntry(entry[2][1], entry[2][2], path)
+              for path, entry in self.dirs.items() if entry[2] and entry[2][1]]
+    result.sort(key=lambda x: (x.name.lower(), version_key(x.version), x.path))
+    return result
+
+  def find(self, name, version=None):
+    """
+    Returns the `LibraryEntry` of the library *name* with the specified
+    *version*, or the latest version if *version* is `None`.
+    """
+
+    matches = [x for x in self.libraries()
+               if x.name == name and (version is None or x.version == version)]
+    return matches[-1] if matches else None
+
+  def save(self):
+    if self.filename and self.changed:
+      data = {'version': INDEX_VERSION, 'roots': self.roots, 'dirs': self.dirs}
+      write_atomic(self.filename, json.dumps(data))
+      self.changed = False
+
+
+def _is_valid(entry):
+  config = _read_library(entry.path, None)
+  return config[1] == entry.name and config[2] == entry.version
+
+
+def resolve_library(spec, index=None, jobs=None):
+  """
+  Returns the `LibraryEntry` for a `NAME[@VERSION]` *spec* or `None` if no
+  such library was found. The library is looked up in the saved index, which
+  is only refreshed if the library is not in it, its configuration does not
+  match anymore or the search roots changed. Thus without a version, the
+  latest version known to the index is returned.
+  """
+
+  name, version = parse_spec(spec)
+  if index is None:
+    index = DiscoveryIndex(get_index_filename())
+  entry = index.find(name, version)
+  if entry is None or not _is_valid(entry) or index.roots != get_search_roots():
+    index.refresh(jobs=jobs)
+    try:
+      index.save()
+    except OSError:
+      pass
+    entry = index.find(name, version)
+  return entry
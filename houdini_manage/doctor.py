@@ -0,0 +1,285 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Health checks for the libraries installed in a Houdini environment file.
+Libraries are checked in parallel and the results are cached per library
+with a fingerprint of the modification times of the files involved, thus
+repeated runs only check libraries that changed.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from . import tracing
+from .config import write_atomic
+from .library import CONFIG_FILE, get_houdini_version, get_mtime
+
+DSO_EXTENSIONS = ('.so', '.dll', '.dylib')
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cxx', '.cpp')
+
+# Increment when the checks change to invalidate cached results.
+CACHE_VERSION = 1
+
+
+class Issue(object):
+
+  def __init__(self, code, message):
+    self.code = code
+    self.message = message
+
+  def to_json(self):
+    return {'code': self.code, 'message': self.message}
+
+
+class LibraryReport(object):
+
+  def __init__(self, name, version, path, issues, cached=False):
+    self.name = name
+    self.version = version
+    self.path = path
+    self.issues = issues
+    self.cached = cached
+
+  @property
+  def ok(self):
+    return not self.issues
+
+  def to_json(self):
+    return {
+      'name': self.name,
+      'version': self.version,
+      'path': self.path,
+      'ok': self.ok,
+      'issues': [x.to_json() for x in self.issues],
+    }
+
+
+def _scan(directory):
+  """
+  Returns a dictionary that maps the names of the files in *directory* to
+  their modification time, or `None` if the directory does not exist.
+  """
+
+  try:
+    entries = list(os.scandir(directory))
+  except OSError:
+    return None
+  result = {}
+  for entry in entries:
+    try:
+      result[entry.name] = entry.stat().st_mtime
+    except OSError:
+      pass
+  return result
+
+
+def _read_json(filename):
+  try:
+    with open(filename) as fp:
+      return json.load(fp), None
+  except OSError:
+    return None, None
+  except ValueError as exc:
+    return None, str(exc)
+
+
+def fingerprint(section, houdini_version, source_dir='dso_source'):
+  """
+  Computes the fingerprint of a library section. It covers the values in
+  the envfile and the modification times of the library directory, its
+  configuration and the DSO source and output files. *source_dir* is the
+  `dsoSource` of the library, if it changes then so does the modification
+  time of the configuration file.
+  """
+
+  path = section.get_library_path()
+  result = [section.get_library_name(), section.get_library_version(), path,
+            houdini_version, CACHE_VERSION]
+  if path:
+    config_file = os.path.join(path, CONFIG_FILE)
+    result += [get_mtime(path), get_mtime(config_file),
+               get_mtime(os.path.join(path, 'build', 'dso-build.json'))]
+    result.append(_scan(os.path.join(path, 'dso')))
+    result.append(_scan(os.path.join(path, source_dir)))
+  # JSON turns tuples into lists, round-trip the fingerprint to be able to
+  # compare it with cached fingerprints.
+  return json.loads(json.dumps(result))
+
+
+def check_library(section, houdini_version):
+  """
+  Checks the library *section* of an envfile. *houdini_version* is the
+  `MAJOR.MINOR` version of Houdini that the envfile is for, or `None` if it
+  is unknown. Returns a list of `Issue` objects.
+  """
+
+  name = section.get_library_name()
+  version = section.get_library_version()
+  path = section.get_library_path()
+  issues = []
+
+  if not version:
+    issues.append(Issue('version-missing', 'HLIBVERSION_{} is not set'.format(name)))
+  if not path:
+    issues.append(Issue('path-missing', 'HLIBPATH_{} is not set'.format(name)))
+    return issues
+  if not os.path.isdir(path):
+    issues.append(Issue('path-not-found', 'library directory does not exist: {}'.format(path)))
+    return issues
+
+  config_file = os.path.join(path, CONFIG_FILE)
+  config, error = _read_json(config_file)
+  if error:
+    issues.append(Issue('config-invalid', 'invalid {}: {}'.format(config_file, error)))
+    return issues
+  if config is None:
+    issues.append(Issue('config-missing', 'missing {}'.format(config_file)))
+    return issues
+  if not isinstance(config, dict) or 'libraryName' not in config or 'libraryVersion' not in config:
+    issues.append(Issue('config-invalid', '{} must specify libraryName and libraryVersion'.format(config_file)))
+    return issues
+  if config['libraryName'] != name:
+    issues.append(Issue('name-mismatch', 'library is named "{}" in {}'.format(
+      config['libraryName'], config_file)))
+  if version and str(config['libraryVersion']) != version:
+    issues.append(Issue('version-mismatch', 'installed v{} but the library is v{}, reinstall it'.format(
+      version, config['libraryVersion'])))
+
+  issues += _check_dsos(path, config, houdini_version)
+  return issues
+
+
+def _check_dsos(path, config, houdini_version):
+  sources = _scan(os.path.join(path, config.get('dsoSource', 'dso_source'))) or {}
+  sources = dict((k, v) for k, v in sources.items()
+                 if os.path.splitext(k)[1].lower() in SOURCE_EXTENSIONS)
+  if not sources:
+    return []
+  dsos = _scan(os.path.join(path, 'dso')) or {}
+  dsos = dict((os.path.splitext(k)[0], v) for k, v in dsos.items()
+              if os.path.splitext(k)[1].lower() in DSO_EXTENSIONS)
+
+  issues = []
+  unity = [v for k, v in dsos.items() if k.startswith(config['libraryName'] + '_unity')]
+  for name, mtime in sorted(sources.items()):
+    stem = os.path.splitext(name)[0]
+    if stem in dsos:
+      built = dsos[stem]
+    elif unity:
+      built = min(unity)
+    else:
+      issues.append(Issue('dso-missing', 'no DSO built for {}'.format(name)))
+      continue
+    if built < mtime:
+      issues.append(Issue('dso-outdated', 'DSO is older than its source {}'.format(name)))
+
+  stamp, _ = _read_json(os.path.join(path, 'build', 'dso-build.json'))
+  built_version = stamp.get('houdiniVersion') if isinstance(stamp, dict) else None
+  if houdini_version and built_version and built_version != houdini_version:
+    issues.append(Issue('dso-houdini-mismatch', 'DSOs were built for Houdini {} but the '
+      'environment is for Houdini {}'.format(built_version, houdini_version)))
+  return issues
+
+
+def _get_source_dir(path):
+  config, _ = _read_json(os.path.join(path, CONFIG_FILE)) if path else (None, None)
+  if isinstance(config, dict):
+    return config.get('dsoSource', 'dso_source')
+  return 'dso_source'
+
+
+class DoctorCache(object):
+  """
+  Persists the issues of every library together with its fingerprint.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.entries = {}
+    self.changed = False
+    if filename:
+      data, _ = _read_json(filename)
+      if isinstance(data, dict):
+        self.entries = data
+
+  def get_source_dir(self, key):
+    entry = self.entries.get(key)
+    return entry.get('sourceDir', 'dso_source') if entry else 'dso_source'
+
+  def get(self, key, fingerprint):
+    entry = self.entries.get(key)
+    if entry and entry['fingerprint'] == fingerprint:
+      return [Issue(x['code'], x['message']) for x in entry['issues']]
+    return None
+
+  def put(self, key, fingerprint, source_dir, issues):
+    self.entries[key] = {'fingerprint': fingerprint, 'sourceDir': source_dir,
+                         'issues': [x.to_json() for x in issues]}
+    self.changed = True
+
+  def save(self):
+    if self.filename and self.changed:
+      write_atomic(self.filename, json.dumps(self.entries))
+      self.changed = False
+
+
+def run_doctor(envfile_name, env, cache=None, jobs=None):
+  """
+  Checks all libraries installed in the `SectionEnvfile` *env* that was
+  loaded from *envfile_name*. Returns a list of `LibraryReport` objects.
+  """
+
+  houdini_version = get_houdini_version(os.path.dirname(os.path.abspath(envfile_name)))
+  sections = [x for x in env.iter_named_sections() if x.is_library()]
+
+  def check(section):
+    key = '{}|{}'.format(os.path.abspath(envfile_name), section.get_library_name())
+    issues = None
+    if cache:
+      issues = cache.get(key, fingerprint(section, houdini_version, cache.get_source_dir(key)))
+    cached = issues is not None
+    if not cached:
+      # Compute the fingerprint before the checks, that way changes during
+      # the check invalidate the cached result.
+      if cache:
+        source_dir = _get_source_dir(section.get_library_path())
+        fp = fingerprint(section, houdini_version, source_dir)
+      with tracing.span('doctor.check', library=section.get_library_name()):
+        issues = check_library(section, houdini_version)
+      if cache:
+        cache.put(key, fp, source_dir, issues)
+    return LibraryReport(section.get_library_name(), section.get_library_version(),
+                         section.get_library_path(), issues, cached)
+
+  with tracing.span('doctor.run', count=len(sections)):
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+      reports = list(pool.map(check, sections))
+  return reports
+
+
+def format_reports(reports):
+  lines = []
+  for report in reports:
+    status = 'OK' if report.ok else '{} problem(s)'.format(len(report.issues))
+    lines.append('* {} v{} ({}): {}'.format(report.name, report.version or '???',
+                                            report.path or '???', status))
+    for issue in report.issues:
+      lines.append('    - {} [{}]'.format(issue.message, issue.code))
+  return '\n'.join(lines)
@@ -23,7 +23,20 @@ Section parser for the Houdini environment file.
 
 import os
 import re
-import shlex
+
+
+def unquote(value):
+  """
+  Returns the value of a variable assignment without its surrounding quotes.
+  Backslashes are kept as they are (they separate Windows paths), only the
+  quotes escaped by `NamedSection.add_variable()` are unescaped.
+  """
+
+  value = value.strip()
+  if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+    value = value[1:-1].replace('\\' + value[0], value[0])
+  return value
+
 
 class Section(object):
 
@@ -95,6 +108,12 @@ class NamedSection(Section):
       return self.extract_var('HLIBVERSION_' + name)
     return None
 
+  def get_library_source(self):
+    name = self.get_library_name()
+    if name:
+      return self.extract_var('HLIBSOURCE_' + name)
+    return None
+
   def add_comment(self, comment):
     lines = comment.split('\n')
     self.content += '\n'.join('# ' + line for line in lines) + '\n'
@@ -112,7 +131,7 @@ class NamedSection(Section):
   def extract_var(self, varname):
     for line in self.content.split('\n'):
       if line.startswith(varname + '='):
-        return shlex.split(line[len(varname) + 1:])[0]
+        return unquote(line[len(varname) + 1:])
     return None
 
   def render(self, fp):
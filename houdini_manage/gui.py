@@ -22,8 +22,9 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 import os
+import threading
 import webbrowser
-from . import __version__, library
+from . import __version__, library, tracing
 from .config import config
 from .envfile import SectionEnvfile
 
@@ -77,8 +78,177 @@ class LibraryModel(QAbstractListModel):
       )
 
 
+class EnvfileCache(object):
+  """
+  Keeps parsed environment files per filename together with the
+  modification time of the file at the time it was parsed. Cached envfiles
+  retain their unsaved changes when switching between Houdini versions.
+  """
+
+  def __init__(self):
+    self._entries = {}
+
+  def get(self, filename):
+    entry = self._entries.get(filename)
+    return entry[0] if entry else None
+
+  def put(self, filename, envfile, mtime=None):
+    if mtime is None:
+      mtime = library.get_mtime(filename)
+    self._entries[filename] = (envfile, mtime)
+
+  def is_stale(self, filename):
+    entry = self._entries.get(filename)
+    return entry is None or entry[1] != library.get_mtime(filename)
+
+  def has_changes(self):
+    return any(envfile.changed for envfile, _ in self._entries.values())
+
+
+class EnvfileLoader(QObject):
+  """
+  Worker that lives in a background thread and performs the Houdini version
+  discovery and envfile parsing.
+  """
+
+  versionsLoaded = pyqtSignal(object, str)
+  envfileLoaded = pyqtSignal(str, object, object)
+  loadFailed = pyqtSignal(str, str)
+
+  @pyqtSlot()
+  def loadVersions(self):
+    prefPaths = library.get_houdini_user_prefs_directories()
+    try:
+      houAppDir = library.get_houdini_application_dir()
+    except OSError:
+      houAppDir = ''
+    self.versionsLoaded.emit(prefPaths, houAppDir)
+
+  @pyqtSlot(str)
+  def loadEnvfile(self, filename):
+    try:
+      mtime = library.get_mtime(filename)
+      with tracing.span('envfile.parse', filename=filename, size=tracing.file_size(filename)):
+        with open(filename) as fp:
+          envfile = SectionEnvfile.parse(fp)
+    except (OSError, ValueError) as exc:
+      self.loadFailed.emit(filename, str(exc))
+    else:
+      self.envfileLoaded.emit(filename, envfile, mtime)
+
+
+class IndexLoader(QObject):
+  """
+  Worker that refreshes the library discovery index. It lives in its own
+  background thread so that walking the search paths never delays loading
+  environment files. A running refresh is cancelled with `stop()`, which may
+  be called from any thread.
+  """
+
+  indexLoaded = pyqtSignal(object)
+
+  def __init__(self, parent=None):
+    QObject.__init__(self, parent)
+    self._stop = threading.Event()
+
+  def stop(self):
+    self._stop.set()
+
+  @pyqtSlot()
+  def refreshIndex(self):
+    from .discover import DiscoveryIndex, get_index_filename
+    index = DiscoveryIndex(get_index_filename())
+    if not index.refresh(stop=self._stop):
+      return
+    try:
+      index.save()
+    except OSError:
+      pass
+    self.indexLoaded.emit(index.libraries())
+
+
+class LibraryPicker(QDialog):
+  """
+  Lists the libraries found in the search paths. The libraries from the
+  saved discovery index are shown immediately and updated when the index
+  was refreshed in the background (see `setLibraries()`).
+  """
+
+  def __init__(self, parent=None):
+    from .discover import DiscoveryIndex, get_index_filename
+    QDialog.__init__(self, parent)
+    self.setWindowTitle('Install Library')
+    self.resize(500, 300)
+    self._path = None
+
+    self.filterEdit = QLineEdit()
+    self.filterEdit.setPlaceholderText('Filter')
+    self.filterEdit.textChanged.connect(self._applyFilter)
+    self.listWidget = QListWidget()
+    self.listWidget.itemDoubleClicked.connect(lambda item: self.accept())
+    self.status = QLabel('')
+    btnBrowse = QPushButton('Browse ...')
+    btnBrowse.clicked.connect(self._browse)
+    buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+    buttons.accepted.connect(self.accept)
+    buttons.rejected.connect(self.reject)
+
+    layout = QVBoxLayout(self)
+    layout.addWidget(self.filterEdit)
+    layout.addWidget(self.listWidget)
+    layout.addWidget(self.status)
+    line = QHBoxLayout()
+    layout.addLayout(line)
+    line.addWidget(btnBrowse)
+    line.addWidget(buttons)
+
+    self.setLibraries(DiscoveryIndex(get_index_filename()).libraries(), refreshed=False)
+
+  def setLibraries(self, libraries, refreshed=True):
+    current = self.listWidget.currentItem()
+    current = current.data(Qt.UserRole) if current else None
+    self.listWidget.clear()
+    for entry in libraries:
+      item = QListWidgetItem('{} v{} ({})'.format(entry.name, entry.version, entry.path))
+      item.setData(Qt.UserRole, entry.path)
+      self.listWidget.addItem(item)
+      if entry.path == current:
+        self.listWidget.setCurrentItem(item)
+    self._applyFilter(self.filterEdit.text())
+    if refreshed:
+      self.status.setText('{} libraries found.'.format(len(libraries)))
+    else:
+      self.status.setText('Searching for libraries ...')
+
+  def selectedPath(self):
+    if self._path:
+      return self._path
+    item = self.listWidget.currentItem()
+    return item.data(Qt.UserRole) if item else None
+
+  def accept(self):
+    if self.selectedPath():
+      QDialog.accept(self)
+
+  def _applyFilter(self, text):
+    text = text.lower()
+    for i in range(self.listWidget.count()):
+      item = self.listWidget.item(i)
+      item.setHidden(text not in item.text().lower())
+
+  def _browse(self):
+    path = QFileDialog.getExistingDirectory(self)
+    if path:
+      self._path = path
+      self.accept()
+
+
 class Window(QWidget):
 
+  _requestVersions = pyqtSignal()
+  _requestEnvfile = pyqtSignal(str)
+  _requestIndex = pyqtSignal()
+
   def __init__(self, parent=None):
     QWidget.__init__(self, parent)
     self.setWindowTitle('Houdini Manage v' + __version__)
@@ -93,7 +263,9 @@ class Window(QWidget):
     self._model = None
     self._envfile = None
     self._envfilename = None
-    self._lastHoudiniVersionIndex = None
+    self._envfiles = EnvfileCache()
+    self._picker = None
+    self._indexRefreshing = False
 
     btnInstall = QPushButton('')
     btnInstall.setIcon(QIcon(os.path.join(resdir, 'install.png')))
@@ -152,54 +324,119 @@ class Window(QWidget):
       vert.addWidget(btnSave)
       vert.addWidget(btnHelp)
 
-    # Init values.
-    self.houdiniPrefPaths = library.get_houdini_user_prefs_directories()
-    self.houdiniVersion.addItems([x[0] for x in self.houdiniPrefPaths])
+    # Discovering the Houdini versions and parsing the environment files
+    # happens in a background thread so that the window shows up
+    # immediately. The results are delivered via queued signals.
+    self.houdiniPrefPaths = []
+    self._loaderThread = QThread(self)
+    self._loader = EnvfileLoader()
+    self._loader.moveToThread(self._loaderThread)
+    self._loader.versionsLoaded.connect(self._versionsLoaded)
+    self._loader.envfileLoaded.connect(self._envfileLoaded)
+    self._loader.loadFailed.connect(self._envfileLoadFailed)
+    self._requestVersions.connect(self._loader.loadVersions)
+    self._requestEnvfile.connect(self._loader.loadEnvfile)
+    self._loaderThread.start()
+    self._indexThread = QThread(self)
+    self._indexLoader = IndexLoader()
+    self._indexLoader.moveToThread(self._indexThread)
+    self._indexLoader.indexLoaded.connect(self._indexLoaded)
+    self._requestIndex.connect(self._indexLoader.refreshIndex)
+    self._indexThread.start()
+    self.houdiniVersion.setEnabled(False)
+    self.houdiniVersion.addItem('Loading ...')
     self.houdiniVersion.currentIndexChanged.connect(self._updateEnv)
-    self.houdiniVersion.setCurrentIndex(0)
-    self.houdiniPath.setText(library.get_houdini_application_dir())
-    self._updateEnv()
+    self._requestVersions.emit()
 
   def closeEvent(self, event):
-    if self._envfile and self._envfile.changed:
+    if self._envfiles.has_changes():
       reply = QMessageBox.question(self, 'Unsaved Changes',
-        'You have unsaved changes in this environment. Do you want to '
-        'quit?', QMessageBox.Yes | QMessageBox.No)
-      if reply == QMessageBox.Yes:
-        event.accept()
-      else:
+        'You have unsaved changes in one or more environments. Do you want '
+        'to quit?', QMessageBox.Yes | QMessageBox.No)
+      if reply != QMessageBox.Yes:
         event.ignore()
-    else:
-      event.accept()
+        return
+    self._indexLoader.stop()
+    for thread in (self._loaderThread, self._indexThread):
+      thread.quit()
+    for thread in (self._loaderThread, self._indexThread):
+      thread.wait()
+    event.accept()
+
+  def _versionsLoaded(self, prefPaths, houAppDir):
+    self.houdiniPrefPaths = prefPaths
+    self.houdiniVersion.blockSignals(True)
+    self.houdiniVersion.clear()
+    self.houdiniVersion.addItems([x[0] for x in self.houdiniPrefPaths])
+    self.houdiniVersion.blockSignals(False)
+    self.houdiniVersion.setEnabled(True)
+    if not self.houdiniPath.text():
+      self.houdiniPath.setText(houAppDir)
+    self._updateEnv()
 
   def _updateEnv(self):
     index = self.houdiniVersion.currentIndex()
-    if self._envfile and self._envfile.changed and index != self._lastHoudiniVersionIndex:
-      reply = QMessageBox.question(self, 'Unsaved Changes',
-        'You have unsaved changes in this environment. Do you want to '
-        'switch versions?', QMessageBox.Yes | QMessageBox.No)
-      if reply != QMessageBox.Yes:
-        self.houdiniVersion.setCurrentIndex(self._lastHoudiniVersionIndex)
-        return
-    if index == self._lastHoudiniVersionIndex:
+    if index < 0 or index >= len(self.houdiniPrefPaths):
+      self._setEnvfile(None, None)
       return
     path = self.houdiniPrefPaths[index][1]
-    self._lastHoudiniVersionIndex = index
-    if os.path.isfile(path):
-      self._envfilename = path
-      with open(path) as fp:
-        self._envfile = SectionEnvfile.parse(fp)
-      self._model = LibraryModel(self._envfile)
-    else:
-      self._envfilename = None
-      self._envfile = None
-      self._model = None
+    envfile = self._envfiles.get(path)
+    self._setEnvfile(path, envfile)
+    # Envfiles with unsaved changes are never reloaded. Otherwise we check
+    # if the file changed on disk since we parsed it.
+    if envfile is None or (not envfile.changed and self._envfiles.is_stale(path)):
+      self._requestEnvfile.emit(path)
+
+  def _setEnvfile(self, path, envfile):
+    self._envfilename = path
+    self._envfile = envfile
+    self._model = LibraryModel(envfile) if envfile else None
     self.listView.setModel(self._model)
 
+  def _envfileLoaded(self, path, envfile, mtime):
+    previous = self._envfiles.get(path)
+    if previous is not None and previous.changed:
+      # The user made changes while the file was reloaded, keep them.
+      return
+    self._envfiles.put(path, envfile, mtime)
+    if path == self._envfilename:
+      self._setEnvfile(path, envfile)
+
+  def _envfileLoadFailed(self, path, message):
+    if path == self._envfilename:
+      error_dialog('Could not load environment file', message)
+
+  def _indexLoaded(self, libraries):
+    self._indexRefreshing = False
+    if self._picker:
+      self._picker.setLibraries(libraries)
+
+  def _pickLibrary(self):
+    """
+    Returns the directory of the library to install. If search paths are
+    configured, the library can be picked from the discovered libraries.
+    """
+
+    from .discover import get_search_roots
+    if not get_search_roots():
+      return QFileDialog.getExistingDirectory(self)
+    self._picker = LibraryPicker(self)
+    # A refresh that is still running delivers its result to this picker.
+    if not self._indexRefreshing:
+      self._indexRefreshing = True
+      self._requestIndex.emit()
+    try:
+      if self._picker.exec_() != QDialog.Accepted:
+        return None
+      return self._picker.selectedPath()
+    finally:
+      self._picker = None
+    self._indexRefreshing = False
+
   def _install(self):
     if not self._envfile:
       return
-    directory = QFileDialog.getExistingDirectory(self)
+    directory = self._pickLibrary()
     if not directory:
       return
     hou_app_dir = self.houdiniPath.text()
@@ -208,7 +445,8 @@ class Window(QWidget):
     try:
       library.install_library(self._envfile, directory)
       if hou_app_dir:
-        if not library.build_dso(hou_app_dir, directory):
+        num, ok = library.build_dso(hou_app_dir, directory)
+        if not ok:
           error_dialog('DSO build failed', 'Check console for more information.')
     except library.NotALibraryError as exc:
       error_dialog('Not a Houdini Library', str(exc))
@@ -220,6 +458,8 @@ class Window(QWidget):
       self._model.update()
 
   def _remove(self):
+    if not self._model:
+      return
     index = self.listView.selectionModel().selectedIndexes()
     if len(index) != 1:
       return
@@ -231,6 +471,8 @@ class Window(QWidget):
     if not hou_app_dir:
       error_dialog('Error', 'Specify the Houdini Application Path to build DSOs.')
       return
+    if not self._model:
+      return
     count = 0
     num_built = 0
     for index in self.listView.selectionModel().selectedIndexes():
@@ -250,8 +492,11 @@ class Window(QWidget):
   def _save(self):
     if not self._envfile or not self._envfilename:
       return
-    with open(self._envfilename, 'w') as fp:
-      self._envfile.render(fp)
+    with tracing.span('envfile.save', filename=self._envfilename) as args:
+      with open(self._envfilename, 'w') as fp:
+        self._envfile.render(fp)
+      args['size'] = tracing.file_size(self._envfilename)
+    self._envfiles.put(self._envfilename, self._envfile)
 
   def _help(self):
     webbrowser.open('https://niklasrosenstein.github.io/houdini-manage/')
@@ -309,9 +554,21 @@ def error_dialog(title, message):
   QMessageBox.critical(None, title, message)
 
 
-def main():
+def main(profile=None):
+  """
+  Runs the GUI. If *profile* is specified (defaults to the
+  `HOUDINI_MANAGE_PROFILE` environment variable), timings are recorded and
+  written as a Chrome trace to that file when the GUI is closed.
+  """
+
+  profile = profile or os.getenv('HOUDINI_MANAGE_PROFILE')
+  recorder = tracing.Recorder().install() if profile else None
   app = QApplication([])
   wnd = Window()
   wnd.show()
   app.exec_()
+  if recorder:
+    recorder.uninstall()
+    recorder.write_chrome_trace(profile)
+    print(recorder.summary())
   return 0
@@ -18,15 +18,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import datetime
-import json
 import os
 import operator
-import shlex
-import subprocess
-from . import __version__
+from . import __version__, tracing
 from .config import config
 
+# Name of the configuration file in the root directory of a library.
+CONFIG_FILE = 'houdini-library.json'
+
 
 def get_houdini_environment_path(hou=None):
   hou = hou or config.get('houdinienv', 'houdini16.0')
@@ -40,25 +39,96 @@ def get_houdini_user_prefs_directories():
   if not os.path.isdir(directory):
     return []
   result = []
-  for name in os.listdir(directory):
-    envfile = os.path.join(directory, name, 'houdini.env')
-    if name.startswith('houdini') and os.path.isfile(envfile):
-      result.append((name, envfile))
+  with tracing.span('scan.prefs', directory=directory) as args:
+    for name in os.listdir(directory):
+      envfile = os.path.join(directory, name, 'houdini.env')
+      if name.startswith('houdini') and os.path.isfile(envfile):
+        result.append((name, envfile))
+    args['count'] = len(result)
   result.sort(key=operator.itemgetter(0), reverse=True)
   return result
 
 
+def get_houdini_version(path):
+  """
+  Extracts the `MAJOR.MINOR` Houdini version from the last element of
+  *path*, eg. `houdini16.5` (a preferences directory) or `hfs16.5.439` (an
+  application directory). Returns `None` if it contains no version.
+  """
+
+  import re
+  match = re.search(r'(\d+\.\d+)', os.path.basename(os.path.normpath(path)))
+  return match.group(1) if match else None
+
+
+def get_mtime(path):
+  """
+  Returns the modification time of *path* or `None` if it does not exist.
+  """
+
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
 def load_library_config(directory):
-  config_file = os.path.join(directory, 'houdini-library.json')
+  config_file = os.path.join(directory, CONFIG_FILE)
   if not os.path.isfile(config_file):
     raise NotALibraryError('missing library configuration file: {}'.format(config_file))
-  with open(config_file) as fp:
-    return json.load(fp)
+  import json
+  with tracing.span('library.load_config', filename=config_file):
+    with open(config_file) as fp:
+      return json.load(fp)
+
 
+def prepare_library(directory, mirror=False):
+  """
+  Returns a tuple of the absolute path to the library *directory* and its
+  configuration. Libraries distributed as archives are extracted into the
+  local library store first. If *mirror* is True, other libraries are
+  mirrored into the local mirror directory and its path is returned.
+  """
 
-def install_library(env, directory, overwrite=False):
-  # Open the librarie's configuration file.
+  from .archive import is_archive, extract_library
+  if is_archive(directory):
+    with tracing.span('archive.extract', filename=directory, size=tracing.file_size(directory)):
+      directory = extract_library(directory)
+  elif mirror:
+    from .mirror import mirror_library
+    result = mirror_library(directory)
+    return result.directory, result.config
   config = load_library_config(directory)
+  return os.path.normpath(os.path.abspath(directory)), config
+
+
+def get_library_source(directory, mirror):
+  """
+  Returns the path that is recorded as `HLIBSOURCE_<name>` for a library
+  that is installed from *directory*, or `None` if it is not mirrored.
+  """
+
+  from .archive import is_archive
+  if not mirror or is_archive(directory):
+    return None
+  return os.path.normpath(os.path.abspath(directory))
+
+
+def install_library(env, directory, overwrite=False, mirror=False):
+  with tracing.span('library.install', directory=directory):
+    source = get_library_source(directory, mirror)
+    # Open the librarie's configuration file.
+    directory, config = prepare_library(directory, mirror)
+    return install_prepared_library(env, directory, config, overwrite, source)
+
+
+def install_prepared_library(env, directory, config, overwrite=False, source=None):
+  """
+  Adds the section for the library in *directory* with the configuration
+  *config* to *env*. *source* is the original location of a mirrored library.
+  """
+
+  import datetime
 
   now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
   version = __version__
@@ -80,7 +150,6 @@ def install_library(env, directory, overwrite=False):
   section.add_variable('PYTHONPATH', '&')
 
   # Create or update the section for this library.
-  directory = os.path.normpath(os.path.abspath(directory))
   section = env.get_named_section('library:' + config['libraryName'])
   if not section:
     previous = False
@@ -102,16 +171,20 @@ def install_library(env, directory, overwrite=False):
   section.add_variable('PYTHONPATH', '$PYTHONPATH', os.path.join(directory, 'python'))
   section.add_variable('HLIBPATH_' + config['libraryName'], directory)
   section.add_variable('HLIBVERSION_' + config['libraryName'], config['libraryVersion'])
+  if source:
+    section.add_variable('HLIBSOURCE_' + config['libraryName'], source)
   if config.get('environment'):
     section.add_comment('Environment variables specified by the library:')
     for line in config['environment']:
       section.add_line(line)
 
+  return config
+
 
 def remove_library(env, name):
   section = env.get_library(name)
   if section:
-    env.remove_section(section)
+    env.remove_section(section.name)
     return True
   return False
 
@@ -121,6 +194,7 @@ def get_houdini_application_dir():
   if install_dir:
     return install_dir
   if os.name == 'nt':
+    import shlex
     import winreg
     key = winreg.OpenKey(winreg.HKEY_CLASSES_ROOT, 'Houdini.hip\\shell\\open\\command')
     path = shlex.split(winreg.QueryValue(key, None))[0]
@@ -130,7 +204,105 @@ def get_houdini_application_dir():
   return path
 
 
+def get_dso_unity_units(config, files):
+  """
+  Groups the C++ source *files* into unity translation units according to
+  the `dsoUnity` option of the library *config*. Returns a tuple of the list
+  of units (each a list of source files) and the list of files that are
+  built individually. Plain C sources are never combined with C++ sources.
+  """
+
+  count = config.get('dsoUnity')
+  if count is True:
+    count = 1
+  if not count or count < 1:
+    return [], list(files)
+
+  cpp_files = [x for x in files if os.path.splitext(x)[1].lower() != '.c']
+  other_files = [x for x in files if x not in cpp_files]
+  if len(cpp_files) < 2:
+    return [], list(files)
+
+  count = min(count, len(cpp_files))
+  size, remainder = divmod(len(cpp_files), count)
+  units = []
+  index = 0
+  for i in range(count):
+    end = index + size + (1 if i < remainder else 0)
+    units.append(cpp_files[index:end])
+    index = end
+  return units, other_files
+
+
+# The functions that Houdini calls to register the contents of a DSO and
+# their parameter types. Every source of an operator library defines the same
+# hooks, in unity builds they are renamed per source and called from a
+# single generated hook.
+DSO_HOOKS = [
+  ('newSopOperator', 'OP_OperatorTable *'),
+  ('newObjectOperator', 'OP_OperatorTable *'),
+  ('newDriverOperator', 'OP_OperatorTable *'),
+  ('newCop2Operator', 'OP_OperatorTable *'),
+  ('newChopOperator', 'OP_OperatorTable *'),
+  ('newShopOperator', 'OP_OperatorTable *'),
+  ('newVopOperator', 'OP_OperatorTable *'),
+  ('newDopOperator', 'OP_OperatorTable *'),
+  ('newLopOperator', 'OP_OperatorTable *'),
+  ('newVEXOp', 'void *'),
+  ('newGeometryPrim', 'GA_PrimitiveFactory *'),
+  ('newGeometryIO', 'void *'),
+  ('CMDextendLibrary', 'CMD_Manager *'),
+  ('initializeSIM', 'void *'),
+]
+
+
+def get_dso_hooks(source):
+  """
+  Returns the names of the `DSO_HOOKS` that appear in the *source* file.
+  """
+
+  import re
+  try:
+    with open(source) as fp:
+      text = fp.read()
+  except (OSError, UnicodeDecodeError):
+    return []
+  return [name for name, _ in DSO_HOOKS if re.search(r'\b{}\s*\('.format(name), text)]
+
+
+def write_dso_unity_source(filename, sources):
+  """
+  Writes a unity translation unit that includes all *sources*. Since the
+  sources are included by their absolute path, compiler diagnostics still
+  refer to the original source files. The `DSO_HOOKS` of every source are
+  renamed to `<hook>_<index>` and the unit defines every hook once, calling
+  the hooks of all sources.
+  """
+
+  hooks = {}
+  with open(filename, 'w') as fp:
+    fp.write('// Unity build generated by houdini-manage v{}\n'.format(__version__))
+    fp.write('#include <SYS/SYS_Visibility.h>\n')
+    for index, source in enumerate(sources):
+      names = get_dso_hooks(source)
+      for name in names:
+        fp.write('#define {0} {0}_{1}\n'.format(name, index))
+        hooks.setdefault(name, []).append(index)
+      fp.write('#include "{}"\n'.format(source.replace('\\', '/')))
+      for name in names:
+        fp.write('#undef {}\n'.format(name))
+    for name, param in DSO_HOOKS:
+      if name not in hooks:
+        continue
+      fp.write('\nextern "C" SYS_VISIBILITY_EXPORT void {}({}arg)\n{{\n'.format(name, param))
+      for index in hooks[name]:
+        fp.write('  {}_{}(arg);\n'.format(name, index))
+      fp.write('}\n')
+
+
 def build_dso(hou_app_dir, library_dir):
+  import subprocess
+
   hcustom = os.path.join(hou_app_dir, 'bin\\hcustom.exe' if os.name == 'nt' else 'bin/hcustom')
   library_dir = os.path.abspath(library_dir)
   config = load_library_config(library_dir)
@@ -144,7 +316,7 @@ def build_dso(hou_app_dir, library_dir):
     os.makedirs(dso_dir)
 
   files = []
-  for name in os.listdir(dso_source):
+  for name in sorted(os.listdir(dso_source)):
     ext = os.path.splitext(name)[1].lower()
     if ext in ('.c', '.cc', '.cxx', '.cpp'):
       files.append(os.path.join(dso_source, name))
@@ -154,7 +326,7 @@ def build_dso(hou_app_dir, library_dir):
 
   command = [hcustom]
   if config.get('dsoDebug'):
-    command += '-g'
+    command += ['-g']
   for path in config.get('dsoInclude', []):
     command += ['-I', os.path.join(library_dir, path)]
   for path in config.get('dsoLibdir', []):
@@ -163,21 +335,70 @@ def build_dso(hou_app_dir, library_dir):
     command += ['-l', lib]
   command += ['-i', dso_dir]
 
-  print('Building DSOs for "{}" ...'.format(config['libraryName']))
-
-  ok = True
-  for filename in files:
-    current_command = command + [filename]
+  def build(filename, label=None):
     print()
-    print('  {} ...'.format(os.path.basename(filename)))
+    print('  {} ...'.format(label or os.path.basename(filename)))
     print()
-    res = subprocess.call(current_command, cwd=dso_dir)
+    with tracing.span('hcustom', 'subprocess', source=filename) as args:
+      res = args['returncode'] = subprocess.call(command + [filename], cwd=dso_dir)
     if res != 0:
       print('Error: hcustom failed with exit code', res)
+    return res == 0
+
+  print('Building DSOs for "{}" ...'.format(config['libraryName']))
+
+  ok = True
+  total = len(files)
+  units, files = get_dso_unity_units(config, files)
+  unity_prefix = config['libraryName'] + '_unity'
+  if units:
+    unity_dir = os.path.join(library_dir, 'build', 'unity')
+    if not os.path.isdir(unity_dir):
+      os.makedirs(unity_dir)
+  # DSOs from a previous build with a different unity configuration would
+  # register the same operators twice.
+  def is_stale_unity(stem):
+    suffix = stem[len(unity_prefix):]
+    return stem.startswith(unity_prefix) and suffix.isdigit() and int(suffix) >= len(units)
+  _remove_dsos(dso_dir, is_stale_unity)
+
+  for index, sources in enumerate(units):
+    filename = os.path.join(unity_dir, '{}{}.cpp'.format(unity_prefix, index))
+    write_dso_unity_source(filename, sources)
+    label = '{} ({})'.format(os.path.basename(filename),
+      ', '.join(os.path.basename(x) for x in sources))
+    stems = set(os.path.splitext(os.path.basename(x))[0] for x in sources)
+    if build(filename, label):
+      _remove_dsos(dso_dir, stems.__contains__)
+    else:
+      # Fall back to building the sources of this unit one by one, that
+      # way we know which of the sources is causing the error.
+      print('Unity build failed, building sources individually ...')
+      _remove_dsos(dso_dir, '{}{}'.format(unity_prefix, index).__eq__)
+      files += sources
+
+  for filename in files:
+    if not build(filename):
       ok = False
 
+  # Remember the Houdini version the DSOs were built with.
+  import json
+  from .config import write_atomic
+  write_atomic(os.path.join(library_dir, 'build', 'dso-build.json'), json.dumps({
+    'houdiniAppDir': hou_app_dir,
+    'houdiniVersion': get_houdini_version(hou_app_dir),
+    'ok': ok,
+  }))
+
   print('Done.')
-  return len(files), ok
+  return total, ok
+
+
+def _remove_dsos(dso_dir, predicate):
+  for name in os.listdir(dso_dir):
+    stem, ext = os.path.splitext(name)
+    if ext.lower() in ('.so', '.dll', '.dylib') and predicate(stem):
+      os.remove(os.path.join(dso_dir, name))
 
 
 class InstallError(Exception):
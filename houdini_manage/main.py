@@ -21,8 +21,7 @@
 import argparse
 import os
 import sys
-from . import __version__, library as _library
-from .envfile import SectionEnvfile
+from . import __version__
 
 
 # http://www.sidefx.com/docs/houdini/ref/env
@@ -91,89 +90,446 @@ HOUDINI_PATH_ENVVARS = [
 ]
 
 
+BACKENDS = ['envfile', 'packages']
+
 parser = argparse.ArgumentParser(prog='houdini-manage')
 parser.add_argument('hou', nargs='?', help='The name of the Houdini version.')
 parser.add_argument('--version', action='version', version=__version__)
 parser.add_argument('--gui', action='store_true', help='Runs the GUI.')
-parser.add_argument('-i', '--install', metavar='LIBRARY', help='Install the specified Houdini library.')
+parser.add_argument('-i', '--install', metavar='LIBRARY', help='Install the specified Houdini library. Can be a directory, an archive or NAME[@VERSION] of a library in the search paths.')
 parser.add_argument('--remove', metavar='LIBRARY', help='Remove a Houdini library.')
 parser.add_argument('--version-of', metavar='LIBRARY', help='Print the version of a Houdini library.')
 parser.add_argument('--path-of', metavar='LIBRARY', help='Print the path of a Houdini library.')
 parser.add_argument('-l', '--list', action='store_true', help='List all installed Houdini libraries.')
-parser.add_argument('--dry', action='store_true', help='Do not save changes to the environment file, but print the new content instead. Only with --install and --remove.')
+parser.add_argument('--enable', metavar='LIBRARY', help='Enable a Houdini library. Only with the packages backend.')
+parser.add_argument('--disable', metavar='LIBRARY', help='Disable a Houdini library. Only with the packages backend.')
+parser.add_argument('--discover', action='store_true', help='Refresh the index of the libraries in the search paths and list them.')
+parser.add_argument('--sync', action='store_true', help='Refresh the local mirrors of all libraries that were installed with --mirror.')
+parser.add_argument('--migrate', action='store_true', help='Convert the libraries installed in the environment file to Houdini package files.')
+parser.add_argument('--backend', choices=BACKENDS, help='Install libraries into the environment file or as Houdini package files. Overrides the "backend" configuration option.')
+parser.add_argument('--provision', metavar='TEMPLATE', help='Generate environment files from the TEMPLATE environment file for all --targets.')
+parser.add_argument('--library', metavar='LIBRARY', action='append', default=[], help='A library to install into the generated environment files. Can be specified multiple times. Only with --provision.')
+parser.add_argument('--targets', metavar='FILE', help='A file that lists the environment files to generate. Only with --provision.')
+parser.add_argument('-j', '--jobs', metavar='N', type=int, help='Number of worker threads. Only with --provision, --doctor, --sync, --discover and --install.')
+parser.add_argument('--analyze', action='store_true', help='Estimate the directories and files that Houdini examines at startup for the environment file.')
+parser.add_argument('--doctor', action='store_true', help='Check all installed Houdini libraries for problems.')
+parser.add_argument('--compare', metavar='HOU', help='Compare the analysis with another Houdini environment file. Only with --analyze.')
+parser.add_argument('--json', action='store_true', help='Print the result as JSON. Only with --analyze, --doctor and --discover.')
+parser.add_argument('--mirror', action='store_true', help='Copy the library into the local mirror directory and install the mirror. Only with --install.')
+parser.add_argument('--overwrite', action='store_true', help='Overwrite a previous installation of the library. Only with --install.')
+parser.add_argument('--config', metavar='OPTION=VALUE', action='append', default=[], help='Override a configuration option. Can be specified multiple times.')
+parser.add_argument('--profile', metavar='FILE', help='Record timings of the operation, write them as a Chrome trace to FILE and print a summary.')
+parser.add_argument('--dry', action='store_true', help='Do not save changes to the environment file, but print the new content instead. Only with --install, --remove or --sync and the envfile backend.')
 
 error = lambda *a: print(*a, file=sys.stderr)
 
 
-def _main(argv=None):
-  args = parser.parse_args(argv)
+def _load_env(args):
+  """
+  Returns a tuple of the environment filename and the parsed envfile, or
+  `None` if the file does not exist (in which case an error is printed).
+  """
 
-  # Only one operation valid per invokation.
-  count = sum(map(bool, [args.gui, args.install, args.remove, args.version_of, args.path_of, args.list]))
-  if count == 0:
-    parser.print_usage()
-    return
-  if count != 1:
-    error('fatal: no or multiple operations specified')
-    return 1
-
-  if args.gui:
-    from .gui import main
-    return main()
+  from . import tracing
+  from .envfile import SectionEnvfile
+  from .library import get_houdini_environment_path
 
   # Determine the Houdini environment file to work on.
-  # TODO: Parse user configuration file.
-  hou = _library.get_houdini_environment_path(args.hou)
+  with tracing.span('envfile.resolve') as span_args:
+    hou = span_args['filename'] = get_houdini_environment_path(args.hou)
   if not os.path.isfile(hou):
     error('fatal: file does not exist: {}'.format(hou))
-    return 1
+    return None
 
   # Parse the environment file into its sections.
-  with open(hou) as fp:
-    env = SectionEnvfile.parse(fp)
-
-  def save_env():
-    with open(hou, 'w') as fp:
-      env.render(fp)
-
-  if args.list:
-    for section in env.iter_named_sections():
-      if section.is_library():
-        print('* {} v{} ({})'.format(
-          section.get_library_name(),
-          section.get_library_version() or '???',
-          section.get_library_path() or '???'
-        ))
+  with tracing.span('envfile.parse', filename=hou, size=tracing.file_size(hou)):
+    with open(hou) as fp:
+      env = SectionEnvfile.parse(fp)
+  return hou, env
+
+
+def _save_env(args, hou, env):
+  from . import tracing
+  if args.dry:
+    env.render(sys.stdout)
+  else:
+    with tracing.span('envfile.save', filename=hou) as span_args:
+      with open(hou, 'w') as fp:
+        env.render(fp)
+      span_args['size'] = tracing.file_size(hou)
+
+
+def _get_packages_dir(args):
+  """
+  Returns the Houdini packages directory if the `packages` backend is used,
+  otherwise `None`.
+  """
+
+  from .config import config
+  if config['backend'] != 'packages':
+    return None
+  from .library import get_houdini_environment_path
+  from .packages import get_packages_directory
+  return get_packages_directory(get_houdini_environment_path(args.hou))
+
+
+def _op_gui(args):
+  from .gui import main
+  return main(profile=args.profile)
+
+
+def _op_list(args):
+  packages_dir = _get_packages_dir(args)
+  if packages_dir:
+    from .packages import iter_libraries
+    for package in iter_libraries(packages_dir):
+      print('* {} v{} ({}){}'.format(package.name, package.version or '???',
+        package.path or '???', '' if package.enabled else ' [disabled]'))
     return
 
-  if args.version_of or args.path_of:
-    section = env.get_library(args.version_of or args.path_of)
-    if not section:
-      error('fatal: library "{}" not installed'.format(args.version_of or args.path_of))
+  loaded = _load_env(args)
+  if not loaded:
+    return 1
+  hou, env = loaded
+  for section in env.iter_named_sections():
+    if section.is_library():
+      print('* {} v{} ({})'.format(
+        section.get_library_name(),
+        section.get_library_version() or '???',
+        section.get_library_path() or '???'
+      ))
+
+
+def _op_query(args):
+  name = args.version_of or args.path_of
+  packages_dir = _get_packages_dir(args)
+  if packages_dir:
+    from .packages import get_library
+    package = get_library(packages_dir, name)
+    if not package:
+      error('fatal: library "{}" not installed'.format(name))
       return 1
-    value = section.get_library_version() if args.version_of else section.get_library_path()
-    print(value or '???')
+    print((package.version if args.version_of else package.path) or '???')
     return
 
-  if args.remove:
-    try:
-      env.remove_section('library:' + args.remove)
-    except ValueError:
+  loaded = _load_env(args)
+  if not loaded:
+    return 1
+  hou, env = loaded
+  section = env.get_library(name)
+  if not section:
+    error('fatal: library "{}" not installed'.format(name))
+    return 1
+  value = section.get_library_version() if args.version_of else section.get_library_path()
+  print(value or '???')
+
+
+def _op_toggle(args):
+  packages_dir = _get_packages_dir(args)
+  if not packages_dir:
+    error('fatal: --enable and --disable are only supported by the packages backend')
+    return 1
+  from .packages import set_library_enabled
+  name = args.enable or args.disable
+  if not set_library_enabled(packages_dir, name, bool(args.enable)):
+    error('fatal: library "{}" not installed'.format(name))
+    return 1
+  print('library "{}" {}'.format(name, 'enabled' if args.enable else 'disabled'))
+
+
+def _op_migrate(args):
+  from .library import PreviousInstallationFoundError, get_houdini_environment_path
+  from .packages import get_packages_directory, migrate_envfile
+
+  if args.dry:
+    error('fatal: --migrate does not support --dry')
+    return 1
+  loaded = _load_env(args)
+  if not loaded:
+    return 1
+  hou, env = loaded
+  # Libraries are removed from the environment file as they are migrated,
+  # it is saved even if a later library fails so no library is installed
+  # twice.
+  migrated = []
+  status = 0
+  try:
+    for name in migrate_envfile(env, get_packages_directory(hou), overwrite=args.overwrite):
+      migrated.append(name)
+      print('library "{}" migrated'.format(name))
+  except PreviousInstallationFoundError as exc:
+    error('fatal: package for library "{}" already exists, use --overwrite'.format(exc.library_name))
+    return 1
+  except OSError as exc:
+    error('fatal: {}'.format(exc))
+    status = 1
+  if migrated:
+    _save_env(args, hou, env)
+  return status
+
+
+def _op_analyze(args):
+  from .analyze import ListingCache, analyze_envfile, format_analysis
+  from .config import config, get_cache_dir
+
+  if _get_packages_dir(args):
+    error('fatal: --analyze is only supported by the envfile backend')
+    return 1
+  loaded = _load_env(args)
+  if not loaded:
+    return 1
+  compare = None
+  if args.compare:
+    other_args = argparse.Namespace(**vars(args))
+    other_args.hou = args.compare
+    compare = _load_env(other_args)
+    if not compare:
+      return 1
+
+  cache = ListingCache(os.path.join(get_cache_dir(), 'listings.json'))
+  hou_app_dir = config.get('houdiniapp')
+  analysis = analyze_envfile(loaded[0], loaded[1], cache, hou_app_dir)
+  if compare:
+    compare = analyze_envfile(compare[0], compare[1], cache, hou_app_dir)
+  try:
+    cache.save()
+  except OSError:
+    pass
+
+  if args.json:
+    import json
+    result = analysis.to_json()
+    if compare:
+      result = {'analysis': result, 'compare': compare.to_json()}
+    print(json.dumps(result, indent=2, sort_keys=True))
+  else:
+    print(format_analysis(analysis, compare))
+
+
+def _op_provision(args):
+  from .library import InstallError
+  from .provision import load_targets, provision
+
+  if not args.targets:
+    error('fatal: --provision requires --targets')
+    return 1
+  try:
+    targets = load_targets(args.targets)
+  except (OSError, ValueError, KeyError) as exc:
+    error('fatal: could not load targets: {}'.format(exc))
+    return 1
+  try:
+    errors = provision(args.provision, args.library, targets, args.jobs)
+  except InstallError as exc:
+    error('fatal: {}'.format(exc))
+    return 1
+  except OSError as exc:
+    error('fatal: {}'.format(exc))
+    return 1
+  for target, exc in errors:
+    error('error: {}: {}'.format(target.path, exc))
+  print('{} of {} environment files written'.format(len(targets) - len(errors), len(targets)))
+  return 1 if errors else 0
+
+
+def _op_doctor(args):
+  from .config import get_cache_dir
+  from .doctor import DoctorCache, format_reports, run_doctor
+
+  if _get_packages_dir(args):
+    error('fatal: --doctor is only supported by the envfile backend')
+    return 1
+  loaded = _load_env(args)
+  if not loaded:
+    return 1
+  cache = DoctorCache(os.path.join(get_cache_dir(), 'doctor.json'))
+  reports = run_doctor(loaded[0], loaded[1], cache, args.jobs)
+  try:
+    cache.save()
+  except OSError:
+    pass
+
+  if args.json:
+    import json
+    print(json.dumps([x.to_json() for x in reports], indent=2))
+  else:
+    print(format_reports(reports))
+  return 0 if all(x.ok for x in reports) else 1
+
+
+def _op_remove(args):
+  packages_dir = _get_packages_dir(args)
+  if packages_dir:
+    if args.dry:
+      error('fatal: --dry is not supported by the packages backend')
+      return 1
+    from .packages import remove_library
+    if not remove_library(packages_dir, args.remove):
       print('library "{}" not installed'.format(args.remove))
       return 1
-    else:
-      print('library "{}" removed'.format(args.remove))
-    if not args.dry:
-      save_env()
+    print('library "{}" removed'.format(args.remove))
     return
 
-  if args.install:
-    _library.install_library()
-    print('library "{}" installed'.format(config['libraryName']))
-    if not args.dry:
-      save_env()
+  loaded = _load_env(args)
+  if not loaded:
+    return 1
+  hou, env = loaded
+  try:
+    env.remove_section('library:' + args.remove)
+  except ValueError:
+    print('library "{}" not installed'.format(args.remove))
+    return 1
+  else:
+    print('library "{}" removed'.format(args.remove))
+  _save_env(args, hou, env)
+
+
+def _op_install(args):
+  from .library import install_library, InstallError, PreviousInstallationFoundError
+
+  # Libraries that are not a path are looked up by name in the search paths.
+  directory = args.install
+  if not os.path.exists(directory):
+    from .discover import get_search_roots, resolve_library
+    if get_search_roots():
+      entry = resolve_library(directory, jobs=args.jobs)
+      if not entry:
+        error('fatal: library "{}" not found in the search paths'.format(directory))
+        return 1
+      directory = entry.path
+
+  packages_dir = _get_packages_dir(args)
+  if packages_dir:
+    if args.dry:
+      error('fatal: --dry is not supported by the packages backend')
+      return 1
+    from .packages import install_library
+    hou, env = None, None
+  else:
+    loaded = _load_env(args)
+    if not loaded:
+      return 1
+    hou, env = loaded
+  try:
+    config = install_library(packages_dir or env, directory, overwrite=args.overwrite,
+                             mirror=args.mirror)
+  except PreviousInstallationFoundError as exc:
+    error('fatal: library "{}" is already installed, use --overwrite'.format(exc.library_name))
+    return 1
+  except (InstallError, OSError) as exc:
+    error('fatal: {}'.format(exc))
+    return 1
+  print('library "{}" installed'.format(config['libraryName']))
+  if env:
+    _save_env(args, hou, env)
+
+
+def _op_sync(args):
+  from .mirror import sync_envfile, sync_packages
+
+  packages_dir = _get_packages_dir(args)
+  if packages_dir:
+    if args.dry:
+      error('fatal: --dry is not supported by the packages backend')
+      return 1
+    results = sync_packages(packages_dir, jobs=args.jobs)
+  else:
+    loaded = _load_env(args)
+    if not loaded:
+      return 1
+    hou, env = loaded
+    results = sync_envfile(env, jobs=args.jobs)
+
+  for name, result, exc in results:
+    if exc:
+      error('error: library "{}" could not be synced: {}'.format(name, exc))
+    elif result.changed:
+      print('library "{}" v{} synced: {} copied, {} linked, {} removed'.format(
+        name, result.config['libraryVersion'], result.copied, result.linked, result.removed))
+    else:
+      print('library "{}" v{} is up to date'.format(name, result.config['libraryVersion']))
+  if not packages_dir and any(x[1] and x[1].updated for x in results):
+    _save_env(args, hou, env)
+  return 1 if any(x[2] for x in results) else 0
+
+
+def _op_discover(args):
+  from .discover import DiscoveryIndex, get_index_filename, get_search_roots
+
+  if not get_search_roots():
+    error('fatal: no search paths configured, set the "searchPaths" option')
+    return 1
+  index = DiscoveryIndex(get_index_filename())
+  index.refresh(jobs=args.jobs)
+  try:
+    index.save()
+  except OSError:
+    pass
+
+  libraries = index.libraries()
+  if args.json:
+    import json
+    print(json.dumps([x.to_json() for x in libraries], indent=2))
+  else:
+    for entry in libraries:
+      print('* {} v{} ({})'.format(entry.name, entry.version, entry.path))
+
+
+def _main(argv=None):
+  args = parser.parse_args(argv)
+
+  # Only one operation valid per invokation.
+  count = sum(map(bool, [args.gui, args.install, args.remove, args.version_of,
+    args.path_of, args.list, args.analyze, args.provision, args.doctor,
+    args.enable, args.disable, args.migrate, args.sync, args.discover]))
+  if count == 0:
+    parser.print_usage()
     return
-  return library(args)
+  if count != 1:
+    error('fatal: no or multiple operations specified')
+    return 1
+
+  if args.config:
+    from .config import config
+    for item in args.config:
+      key, sep, value = item.partition('=')
+      if not sep:
+        error('fatal: invalid --config argument: {!r}'.format(item))
+        return 1
+      config.set_override(key.strip(), value)
+  if args.backend:
+    from .config import config
+    config.set_override('backend', args.backend)
+
+  # Every operation imports only the modules that it needs to keep the
+  # startup time of the CLI low.
+  operations = [
+    (args.gui, _op_gui),
+    (args.install, _op_install),
+    (args.remove, _op_remove),
+    (args.version_of or args.path_of, _op_query),
+    (args.list, _op_list),
+    (args.analyze, _op_analyze),
+    (args.provision, _op_provision),
+    (args.doctor, _op_doctor),
+    (args.enable or args.disable, _op_toggle),
+    (args.migrate, _op_migrate),
+    (args.sync, _op_sync),
+    (args.discover, _op_discover),
+  ]
+  func = next(func for value, func in operations if value)
+  if not args.profile or func is _op_gui:
+    return func(args)
+
+  from . import tracing
+  recorder = tracing.Recorder().install()
+  try:
+    with tracing.span(func.__name__[4:]):
+      return func(args)
+  finally:
+    recorder.uninstall()
+    recorder.write_chrome_trace(args.profile)
+    print(recorder.summary(), file=sys.stderr)
 
 
 def main(argv=None):
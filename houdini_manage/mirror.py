@@ -0,0 +1,285 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Mirrors libraries from slow (eg. network) locations into a local directory.
+
+A library is mirrored to `<mirrorDir>/<libraryName>/<libraryVersion>/`. Files
+are compared by size and modification time and only files that differ are
+copied, in parallel. Files that are unchanged in another mirrored version of
+the same library are hard-linked instead of copied. Mirrored files are never
+modified in place but replaced, thus a change in one version never affects
+another version that links to the same file.
+
+The original location of a mirrored library is recorded as `HLIBSOURCE_<name>`
+in the environment file (or the package file), `sync_envfile()` and
+`sync_packages()` use it to refresh all mirrored libraries.
+"""
+
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import tracing
+from .config import config, get_data_dir
+from .library import CONFIG_FILE, load_library_config
+
+
+def get_mirror_directory():
+  return config.get('mirrordir') or os.path.join(get_data_dir(), 'mirror')
+
+
+class MirrorResult(object):
+  """
+  The result of `mirror_library()`. *directory* is the local mirror of the
+  library and *config* its configuration. The other members count the files
+  that were copied, hard-linked from another version, left unchanged and
+  removed from the mirror. *updated* is set by the sync functions if the
+  section or package of the library was updated.
+  """
+
+  def __init__(self, directory, config):
+    self.directory = directory
+    self.config = config
+    self.copied = 0
+    self.linked = 0
+    self.unchanged = 0
+    self.removed = 0
+    self.updated = False
+
+  @property
+  def changed(self):
+    return bool(self.copied or self.linked or self.removed)
+
+  def to_json(self):
+    return {'directory': self.directory, 'copied': self.copied, 'linked': self.linked,
+            'unchanged': self.unchanged, 'removed': self.removed}
+
+
+def _scan_dir(root, rel, strict=False):
+  """
+  Returns a list of `(relpath, is_dir, size, mtime)` tuples for the entries
+  of the directory *rel* in *root*. Modification times are truncated to whole
+  seconds as not all file systems store them more precisely. Symbolic links
+  to directories and broken links are skipped. If *strict* is True, errors
+  are raised, otherwise a directory that can not be listed is empty.
+  """
+
+  try:
+    entries = list(os.scandir(os.path.join(root, rel)))
+  except OSError:
+    if strict:
+      raise
+    return []
+  result = []
+  for entry in entries:
+    path = os.path.join(rel, entry.name) if rel else entry.name
+    try:
+      if entry.is_dir(follow_symlinks=False):
+        result.append((path, True, None, None))
+      elif entry.is_symlink() and (entry.is_dir() or not os.path.exists(entry.path)):
+        continue
+      else:
+        st = entry.stat()
+        result.append((path, False, st.st_size, int(st.st_mtime)))
+    except OSError:
+      if strict:
+        raise
+  return result
+
+
+def _scan_tree(root, pool, strict=False):
+  """
+  Returns a dictionary that maps the relative paths of all files in *root*
+  to a `(size, mtime)` tuple. Directories are listed in parallel in *pool*.
+  """
+
+  files = {}
+  pending = [pool.submit(_scan_dir, root, '', strict)]
+  while pending:
+    for path, is_dir, size, mtime in pending.pop().result():
+      if is_dir:
+        pending.append(pool.submit(_scan_dir, root, path, strict))
+      else:
+        files[path] = (size, mtime)
+  return files
+
+
+def _temp_name(dst):
+  return '{}.tmp-{}-{}'.format(dst, os.getpid(), threading.get_ident())
+
+
+def _replace(dst, write):
+  """
+  Writes *dst* by calling *write* with a temporary filename, then replaces
+  *dst* with it.
+  """
+
+  tmp = _temp_name(dst)
+  try:
+    write(tmp)
+    os.replace(tmp, dst)
+  except BaseException:
+    if os.path.lexists(tmp):
+      os.remove(tmp)
+    raise
+
+
+def _copy(src, dst):
+  os.makedirs(os.path.dirname(dst), exist_ok=True)
+  _replace(dst, lambda tmp: shutil.copy2(src, tmp))
+
+
+def _link(src, dst, fallback):
+  os.makedirs(os.path.dirname(dst), exist_ok=True)
+  try:
+    _replace(dst, lambda tmp: os.link(src, tmp))
+  except OSError:
+    _copy(fallback, dst)
+
+
+def _remove_empty_dirs(directory):
+  for root, dirs, files in os.walk(directory, topdown=False):
+    if root != directory and not dirs and not files:
+      try:
+        os.rmdir(root)
+      except OSError:
+        pass
+
+
+def _other_versions(library_dir, version_dir):
+  try:
+    names = sorted(os.listdir(library_dir), reverse=True)
+  except OSError:
+    return []
+  return [os.path.join(library_dir, x) for x in names
+          if os.path.join(library_dir, x) != version_dir
+          and os.path.isdir(os.path.join(library_dir, x))]
+
+
+def mirror_library(source, mirror_dir=None, jobs=None):
+  """
+  Mirrors the library in the *source* directory into *mirror_dir* (defaults
+  to `get_mirror_directory()`) and returns a `MirrorResult`. Files that are
+  not in *source* are removed from the mirror.
+  """
+
+  source = os.path.normpath(os.path.abspath(source))
+  config = load_library_config(source)
+  if mirror_dir is None:
+    mirror_dir = get_mirror_directory()
+  library_dir = os.path.join(os.path.abspath(mirror_dir), config['libraryName'])
+  directory = os.path.join(library_dir, str(config['libraryVersion']))
+  result = MirrorResult(directory, config)
+
+  with tracing.span('mirror.library', source=source) as span_args:
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+      with tracing.span('mirror.scan', source=source):
+        # Errors in the source must not be mistaken for removed files.
+        source_files = _scan_tree(source, pool, strict=True)
+        mirror_files = _scan_tree(directory, pool)
+
+      # Find the files that changed, and the ones that can be linked from
+      # another version of the library. Other versions are only scanned
+      # when needed. The configuration file is small and identifies the
+      # version of the mirror, it is always copied.
+      changed = [x for x in sorted(source_files)
+                 if x != CONFIG_FILE and mirror_files.get(x) != source_files[x]]
+      others = None
+      futures = [pool.submit(_copy, os.path.join(source, CONFIG_FILE),
+                             os.path.join(directory, CONFIG_FILE))]
+      for path in changed:
+        if others is None:
+          others = [(x, _scan_tree(x, pool)) for x in _other_versions(library_dir, directory)]
+        other = next((x for x, files in others if files.get(path) == source_files[path]), None)
+        dst = os.path.join(directory, path)
+        if other:
+          result.linked += 1
+          futures.append(pool.submit(_link, os.path.join(other, path), dst, os.path.join(source, path)))
+        else:
+          result.copied += 1
+          futures.append(pool.submit(_copy, os.path.join(source, path), dst))
+      for future in futures:
+        future.result()
+
+      removed = [x for x in mirror_files if x not in source_files]
+      for path in removed:
+        os.remove(os.path.join(directory, path))
+      if removed:
+        _remove_empty_dirs(directory)
+      result.removed = len(removed)
+
+    result.unchanged = len(source_files) - len(changed)
+    span_args.update(result.to_json())
+
+  return result
+
+
+def sync_envfile(env, mirror_dir=None, jobs=None):
+  """
+  Refreshes the mirrors of all libraries in the `SectionEnvfile` *env* that
+  have a `HLIBSOURCE_<name>` variable. Sections are updated if the library
+  version changed. Returns a list of `(name, result, exception)` tuples, a
+  library that could not be synced keeps its current mirror.
+  """
+
+  from .library import InstallError, install_prepared_library
+  results = []
+  for section in list(env.iter_named_sections()):
+    source = section.get_library_source()
+    if not source:
+      continue
+    name = section.get_library_name()
+    try:
+      result = mirror_library(source, mirror_dir, jobs)
+    except (InstallError, OSError, ValueError) as exc:
+      results.append((name, None, exc))
+      continue
+    if (result.directory != section.get_library_path()
+        or str(result.config['libraryVersion']) != section.get_library_version()):
+      install_prepared_library(env, result.directory, result.config, overwrite=True, source=source)
+      result.updated = True
+    results.append((name, result, None))
+  return results
+
+
+def sync_packages(packages_dir, mirror_dir=None, jobs=None):
+  """
+  Like `sync_envfile()` for the libraries installed as package files in
+  *packages_dir*.
+  """
+
+  from .library import InstallError
+  from .packages import Package, build_package, iter_libraries
+  results = []
+  for package in list(iter_libraries(packages_dir)):
+    if not package.source:
+      continue
+    try:
+      result = mirror_library(package.source, mirror_dir, jobs)
+    except (InstallError, OSError, ValueError) as exc:
+      results.append((package.name, None, exc))
+      continue
+    if result.directory != package.path or str(result.config['libraryVersion']) != package.version:
+      data = build_package(result.directory, result.config, source=package.source)
+      data['enable'] = package.enabled
+      Package(package.filename, data).save()
+      result.updated = True
+    results.append((package.name, result, None))
+  return results
@@ -0,0 +1,233 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Backend that installs libraries as Houdini package files (Houdini 17.5 and
+newer) instead of sections in the `houdini.env` file. Every library gets its
+own `<libraryName>.json` in the `packages/` directory of the Houdini user
+preferences, thus installing, removing, enabling or disabling a library only
+touches that one file.
+"""
+
+import datetime
+import json
+import os
+from . import __version__, tracing
+from .config import write_atomic
+from .envfile import unquote
+from .library import get_library_source, prepare_library, InstallError, PreviousInstallationFoundError
+
+# Key in the package file that marks packages managed by Houdini-Manage.
+MARKER = 'houdini-manage'
+
+
+def get_packages_directory(envfile):
+  """
+  Returns the packages directory of the Houdini user preferences directory
+  that contains the environment file *envfile*.
+  """
+
+  return os.path.join(os.path.dirname(os.path.abspath(envfile)), 'packages')
+
+
+class Package(object):
+  """
+  A library that is installed as a package file.
+  """
+
+  def __init__(self, filename, data):
+    self.filename = filename
+    self.data = data
+
+  @property
+  def name(self):
+    return self.data[MARKER]['libraryName']
+
+  @property
+  def version(self):
+    return self.data[MARKER].get('libraryVersion')
+
+  @property
+  def path(self):
+    return self.data.get('hpath')
+
+  @property
+  def source(self):
+    return self.data[MARKER].get('source')
+
+  @property
+  def enabled(self):
+    return self.data.get('enable', True)
+
+  def save(self):
+    write_atomic(self.filename, json.dumps(self.data, indent=2))
+
+
+def build_package(directory, config, source=None):
+  """
+  Returns the contents of the package file for the library in *directory*
+  with the library *config*. It sets the same variables as a library section
+  in the environment file. *source* is the original location of a mirrored
+  library.
+  """
+
+  name = config['libraryName']
+  env = [
+    {'HLIBPATH_' + name: directory},
+    {'HLIBVERSION_' + name: str(config['libraryVersion'])},
+    {'PYTHONPATH': {'method': 'append', 'value': os.path.join(directory, 'python')}},
+  ]
+  if source:
+    env.append({'HLIBSOURCE_' + name: source})
+  for line in config.get('environment', []):
+    var, sep, value = line.partition('=')
+    if not sep:
+      continue
+    env.append({var.strip(): unquote(value)})
+  data = {
+    'env': env,
+    'hpath': directory,
+    'enable': True,
+    MARKER: {
+      'version': __version__,
+      'updated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M'),
+      'libraryName': name,
+      'libraryVersion': str(config['libraryVersion']),
+    },
+  }
+  if source:
+    data[MARKER]['source'] = source
+  return data
+
+
+def get_package_filename(packages_dir, name):
+  return os.path.join(packages_dir, name + '.json')
+
+
+def get_library(packages_dir, name):
+  """
+  Returns the `Package` of the library *name* or `None` if there is no
+  package file for it that was created by Houdini-Manage.
+  """
+
+  filename = get_package_filename(packages_dir, name)
+  try:
+    with open(filename) as fp:
+      data = json.load(fp)
+  except (OSError, ValueError):
+    return None
+  if not isinstance(data, dict) or MARKER not in data:
+    return None
+  return Package(filename, data)
+
+
+def iter_libraries(packages_dir):
+  try:
+    names = sorted(os.listdir(packages_dir))
+  except OSError:
+    return
+  for name in names:
+    if name.endswith('.json'):
+      package = get_library(packages_dir, name[:-5])
+      if package:
+        yield package
+
+
+def install_library(packages_dir, directory, overwrite=False, mirror=False):
+  """
+  Installs the library in *directory* (or an archive) as a package file in
+  *packages_dir*. Returns the library configuration.
+  """
+
+  with tracing.span('packages.install', directory=directory):
+    source = get_library_source(directory, mirror)
+    directory, config = prepare_library(directory, mirror)
+    name = config['libraryName']
+    # Package files that were not created by Houdini-Manage are never
+    # replaced without overwrite either.
+    filename = get_package_filename(packages_dir, name)
+    if not overwrite and os.path.exists(filename):
+      raise PreviousInstallationFoundError(name)
+    package = Package(filename, build_package(directory, config, source))
+    package.save()
+  return config
+
+
+def remove_library(packages_dir, name):
+  package = get_library(packages_dir, name)
+  if package:
+    os.remove(package.filename)
+    return True
+  return False
+
+
+def set_library_enabled(packages_dir, name, enabled):
+  package = get_library(packages_dir, name)
+  if not package:
+    return False
+  package.data['enable'] = enabled
+  package.save()
+  return True
+
+
+def _is_custom_variable(line, name):
+  var = line.partition('=')[0].strip()
+  if not line.partition('=')[1] or var.startswith('#'):
+    return False
+  return var not in ('HOUDINI_PATH', 'PYTHONPATH', 'HLIBPATH_' + name, 'HLIBVERSION_' + name,
+                     'HLIBSOURCE_' + name)
+
+
+def migrate_envfile(env, packages_dir, overwrite=False):
+  """
+  Converts the `library:*` sections of the `SectionEnvfile` *env* into
+  package files and removes them from *env*. If the library directory still
+  exists, the package is created from its configuration, otherwise from the
+  values in the section. Yields the names of the migrated libraries, the
+  sections of the libraries yielded so far are removed from *env*.
+
+  Raises `PreviousInstallationFoundError` before any package is written if
+  a package file exists for one of the libraries and *overwrite* is False.
+  """
+
+  sections = [x for x in env.iter_named_sections() if x.is_library() and x.get_library_path()]
+  if not overwrite:
+    for section in sections:
+      if os.path.exists(get_package_filename(packages_dir, section.get_library_name())):
+        raise PreviousInstallationFoundError(section.get_library_name())
+
+  for section in sections:
+    name = section.get_library_name()
+    path = section.get_library_path()
+    try:
+      directory, config = prepare_library(path)
+    except (InstallError, OSError, ValueError):
+      directory, config = path, None
+    if config is None or config.get('libraryName') != name:
+      # The library is not available or has changed, keep the information
+      # from the environment file.
+      config = {
+        'libraryName': name,
+        'libraryVersion': section.get_library_version() or '',
+        'environment': [x for x in section.content.split('\n') if _is_custom_variable(x, name)],
+      }
+    data = build_package(directory, config, section.get_library_source())
+    Package(get_package_filename(packages_dir, name), data).save()
+    env.remove_section(section.name)
+    yield name
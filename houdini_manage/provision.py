@@ -0,0 +1,122 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Generates many Houdini environment files from a template and a set of
+libraries, eg. for render farm nodes. The template is parsed and the
+libraries are installed into it only once, every target file only adds its
+own overrides to the pre-rendered content.
+"""
+
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from . import tracing
+from .config import write_atomic
+from .envfile import NamedSection, SectionEnvfile
+from .library import install_library
+
+OVERRIDES_SECTION = 'overrides'
+
+
+class Target(object):
+  """
+  A file to generate. *environment* is a list of lines that are added to
+  the `overrides` section of the file.
+  """
+
+  def __init__(self, path, environment=()):
+    self.path = path
+    self.environment = list(environment)
+
+
+def load_targets(filename):
+  """
+  Loads the targets from *filename*. A `.json` file must contain a list of
+  paths or objects with a `path` and an optional `environment` list, any
+  other file contains one path per line.
+  """
+
+  with open(filename) as fp:
+    if filename.lower().endswith('.json'):
+      data = json.load(fp)
+    else:
+      data = [line.strip() for line in fp]
+      data = [x for x in data if x and not x.startswith('#')]
+  targets = []
+  for item in data:
+    if isinstance(item, dict):
+      targets.append(Target(item['path'], item.get('environment', [])))
+    else:
+      targets.append(Target(item))
+  return targets
+
+
+def render_base(template, libraries):
+  """
+  Parses the *template* file, installs all *libraries* into it and returns
+  the rendered content.
+  """
+
+  with tracing.span('provision.render_base', template=template):
+    with open(template) as fp:
+      env = SectionEnvfile.parse(fp)
+    for directory in libraries:
+      install_library(env, directory, overwrite=True)
+    if env.get_named_section(OVERRIDES_SECTION):
+      env.remove_section(OVERRIDES_SECTION)
+    fp = io.StringIO()
+    env.render(fp)
+    return fp.getvalue()
+
+
+def render_target(base, target):
+  if not target.environment:
+    return base
+  section = NamedSection(OVERRIDES_SECTION)
+  for line in target.environment:
+    section.add_line(line)
+  fp = io.StringIO()
+  fp.write(base)
+  section.render(fp)
+  return fp.getvalue()
+
+
+def write_target(base, target):
+  write_atomic(target.path, render_target(base, target))
+
+
+def provision(template, libraries, targets, jobs=None):
+  """
+  Writes an environment file for every `Target` in *targets*. Returns a list
+  of `(target, exception)` tuples for the targets that could not be written.
+  """
+
+  base = render_base(template, libraries)
+  errors = []
+  with tracing.span('provision.write', count=len(targets)):
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+      futures = [(x, pool.submit(write_target, base, x)) for x in targets]
+      for target, future in futures:
+        try:
+          future.result()
+        except OSError as exc:
+          errors.append((target, exc))
+  return errors
@@ -0,0 +1,159 @@
+# Copyright (C) 2017  Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+"""
+Timed spans around the expensive operations of Houdini-Manage (parsing,
+config loading, directory scans, `hcustom` calls, saving). Spans are only
+measured if at least one hook is registered, tools that embed Houdini-Manage
+can collect them with `add_hook()`:
+
+    from houdini_manage import tracing
+    tracing.add_hook(lambda span: print(span.name, span.duration))
+
+The `Recorder` collects spans and writes them in the Chrome trace-event
+format, which can be opened in `chrome://tracing` or https://ui.perfetto.dev.
+"""
+
+import contextlib
+import os
+import threading
+import time
+
+_hooks = []
+
+
+class Span(object):
+  """
+  A finished span. *start* and *duration* are in seconds, *start* is
+  relative to an arbitrary point in time (`time.perf_counter()`).
+  """
+
+  def __init__(self, name, category, start, duration, thread_id, args):
+    self.name = name
+    self.category = category
+    self.start = start
+    self.duration = duration
+    self.thread_id = thread_id
+    self.args = args
+
+
+def add_hook(hook):
+  """
+  Registers a callable that is called with every finished `Span`. Hooks may
+  be called from any thread.
+  """
+
+  _hooks.append(hook)
+
+
+def remove_hook(hook):
+  _hooks.remove(hook)
+
+
+def is_enabled():
+  return bool(_hooks)
+
+
+@contextlib.contextmanager
+def span(name, category='houdini-manage', **args):
+  """
+  Context manager that measures the time of its body. Yields a dictionary
+  to which additional arguments can be added, for example the size of a
+  file after it has been written.
+  """
+
+  if not _hooks:
+    yield args
+    return
+  start = time.perf_counter()
+  try:
+    yield args
+  finally:
+    result = Span(name, category, start, time.perf_counter() - start,
+                  threading.get_ident(), args)
+    for hook in list(_hooks):
+      hook(result)
+
+
+def file_size(filename):
+  try:
+    return os.path.getsize(filename)
+  except OSError:
+    return None
+
+
+class Recorder(object):
+  """
+  Collects spans while it is installed as a hook.
+  """
+
+  def __init__(self):
+    self.spans = []
+    self._lock = threading.Lock()
+    self._origin = time.perf_counter()
+
+  def __call__(self, span):
+    with self._lock:
+      self.spans.append(span)
+
+  def install(self):
+    add_hook(self)
+    return self
+
+  def uninstall(self):
+    remove_hook(self)
+
+  def to_chrome_trace(self):
+    pid = os.getpid()
+    events = []
+    for span in self.spans:
+      events.append({
+        'name': span.name,
+        'cat': span.category,
+        'ph': 'X',
+        'ts': (span.start - self._origin) * 1e6,
+        'dur': span.duration * 1e6,
+        'pid': pid,
+        'tid': span.thread_id,
+        'args': dict((k, v if isinstance(v, (int, float, bool)) or v is None else str(v))
+                     for k, v in span.args.items()),
+      })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+  def write_chrome_trace(self, filename):
+    import json
+    with open(filename, 'w') as fp:
+      json.dump(self.to_chrome_trace(), fp)
+
+  def summary(self):
+    """
+    Returns a table of the total and maximum duration and number of calls
+    per span name, ordered by total duration.
+    """
+
+    stats = {}
+    for span in self.spans:
+      count, total, maximum = stats.get(span.name, (0, 0.0, 0.0))
+      stats[span.name] = (count + 1, total + span.duration, max(maximum, span.duration))
+    width = max([len(x) for x in stats] + [4])
+    lines = ['{:<{w}} {:>6} {:>11} {:>11}'.format('span', 'calls', 'total', 'max', w=width)]
+    for name, (count, total, maximum) in sorted(stats.items(), key=lambda x: -x[1][1]):
+      lines.append('{:<{w}} {:>6} {:>9.1f}ms {:>9.1f}ms'.format(
+        name, count, total * 1000, maximum * 1000, w=width))
+    return '\n'.join(lines)